@@ -1,6 +1,6 @@
 import pyglet
-import sys, os, math, random
-from DIPPID import SensorUDP
+import sys, os, math, random, time
+from DIPPID import SensorUDP, ExponentialSmoothing
 import numpy as np
 
 WIN_WIDTH:int = 500
@@ -22,15 +22,183 @@ SCORE_LABEL_XPOS:int = 15
 SCORE_LABEL_YPOS:int = 15
 SCORE_LABEL_SIZE:int = 25
 
+# steps of the game logic per second, independent of the frame rate.
+# movement is computed per step and was tuned for 60 steps per second.
+SIMULATION_RATE:float = 60
+# frames drawn per second
+RENDER_RATE:float = 60
+# steps run at most to catch up after a slow frame. if the game is further behind,
+# the remaining steps are dropped, so a slow computer does not fall behind more and more
+MAX_STEPS_PER_FRAME:int = 5
+
+# number of segments the arrays of the snake body have room for at first
+SNAKE_BODY_INITIAL_CAPACITY:int = 16
+
+# pack all textures into one texture atlas (set to False to give each image a texture of its own)
+USE_TEXTURE_ATLAS:bool = True
+TEXTURE_ATLAS_SIZE:int = 1024
+# sprites created at startup, so growing the snake or spawning food does not create sprites while playing
+PREALLOCATED_BODY_SPRITES:int = 64
+PREALLOCATED_FOOD_SPRITES:int = 1
+
+# side length of the cells of the spatial hash grids, about the size of a body segment
+GRID_CELL_SIZE:int = 2 * BODY_SEGMENT_SIZE
+
 window = pyglet.window.Window(WIN_WIDTH,WIN_HEIGHT)
 
+# everything is drawn with one batch. the groups decide the order of the layers,
+# so sprites with the same texture in the same layer are drawn with a single draw call.
+batch = pyglet.graphics.Batch()
+BACKGROUND_LAYER = pyglet.graphics.Group(order=0)
+FOOD_LAYER = pyglet.graphics.Group(order=1)
+BODY_LAYER = pyglet.graphics.Group(order=2)
+HEAD_LAYER = pyglet.graphics.Group(order=3)
+UI_LAYER = pyglet.graphics.Group(order=4)
+
 sprite_scale = 0.1
 
+# loads every image only once and keeps its texture for the whole game.
+# textures are centered by default, as the game positions sprites by their center.
+class ResourceCache():
+    def __init__(self, use_atlas:bool=USE_TEXTURE_ATLAS):
+        self._images = {}
+        self._textures = {}
+        self._texture_bin = pyglet.image.atlas.TextureBin(TEXTURE_ATLAS_SIZE, TEXTURE_ATLAS_SIZE) if use_atlas else None
+
+    def _get_image(self, path:str):
+        if path not in self._images:
+            image = pyglet.image.load(path)
+            texture = None
+            if self._texture_bin is not None:
+                try:
+                    # the border keeps neighbouring images from bleeding into each other when scaled
+                    texture = self._texture_bin.add(image, border=1)
+                except pyglet.image.atlas.AllocatorException:
+                    # too large for the atlas
+                    pass
+            if texture is None:
+                texture = image.get_texture()
+            self._images[path] = texture
+        return self._images[path]
+
+    def get_texture(self, path:str, centered:bool=True):
+        key = (path, centered)
+        if key not in self._textures:
+            image = self._get_image(path)
+            # a region of its own, so the anchor of one variant does not change the other
+            texture = image.get_region(0, 0, image.width, image.height)
+            if centered:
+                #move texture's anchor point to the center
+                texture.anchor_x = texture.width//2
+                texture.anchor_y = texture.height//2
+            self._textures[key] = texture
+        return self._textures[key]
+
+# keeps unused sprites of one texture hidden in the batch, so they can be reused instead of created
+class SpritePool():
+    def __init__(self, texture, group:pyglet.graphics.Group, size:int=0):
+        self.texture = texture
+        self.group = group
+        self._free:list[pyglet.sprite.Sprite] = []
+        self.allocate(size)
+
+    def _create_sprite(self) -> pyglet.sprite.Sprite:
+        sprite = pyglet.sprite.Sprite(self.texture, batch=batch, group=self.group)
+        global sprite_scale
+        sprite.scale_x = sprite_scale
+        sprite.scale_y = sprite_scale
+        return sprite
+
+    def allocate(self, count:int):
+        for i in range(count):
+            sprite = self._create_sprite()
+            sprite.visible = False
+            self._free.append(sprite)
+
+    def acquire(self, xpos:float, ypos:float, rotation:float=0) -> pyglet.sprite.Sprite:
+        sprite = self._free.pop() if self._free else self._create_sprite()
+        sprite.position = (xpos, ypos, sprite.z)
+        sprite.rotation = rotation
+        sprite.visible = True
+        return sprite
+
+    def release(self, sprite:pyglet.sprite.Sprite):
+        sprite.visible = False
+        self._free.append(sprite)
+
+# everything is loaded and allocated before the game starts
+resources = ResourceCache()
+body_sprites = SpritePool(resources.get_texture(BODY_TEXTURE_PATH), BODY_LAYER, PREALLOCATED_BODY_SPRITES)
+food_sprites = SpritePool(resources.get_texture(FOOD_TEXTURE_PATH), FOOD_LAYER, PREALLOCATED_FOOD_SPRITES)
+
+# returns a + (b - a) * alpha for angles in radians, turning the shorter way
+def interpolate_angle(a, b, alpha):
+    return a + ((b - a + np.pi) % (2*np.pi) - np.pi) * alpha
+
 #returns the euclidian distance between points (x1, y1) and (x2, y2)
 def euclidian(pos1:tuple[float,float], pos2:tuple[float,float]):
     return math.sqrt( (pos1[0] - pos2[0]) ** 2 + (pos1[1] - pos2[1]) ** 2)
 
+# uniform grid that finds the circles close to a position without checking every circle.
+# items (circles, or numbers of body segments) are stored in the cell of their center and
+# moved to another cell when they leave their cell, so updates are cheap and queries only
+# look at the neighbouring cells.
+class SpatialHashGrid():
+    def __init__(self, cell_size:float=GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        # dicts instead of sets, so items are always returned in the same order
+        self.cells:dict[tuple[int,int], dict] = {}
+        self.item_cells:dict = {}
+        # the largest radius in the grid decides how far around a position a query has to look
+        self.max_radius:float = 0
+
+    def __len__(self) -> int:
+        return len(self.item_cells)
+
+    def get_cell(self, xpos:float, ypos:float) -> tuple[int,int]:
+        return int(xpos // self.cell_size), int(ypos // self.cell_size)
+
+    def insert(self, item, xpos:float, ypos:float, radius:float):
+        cell = self.get_cell(xpos, ypos)
+        self.item_cells[item] = cell
+        self.cells.setdefault(cell, {})[item] = None
+        self.max_radius = max(self.max_radius, radius)
+
+    def remove(self, item):
+        self._remove_from_cell(item, self.item_cells.pop(item))
+
+    def _remove_from_cell(self, item, cell_key:tuple[int,int]):
+        cell = self.cells[cell_key]
+        del cell[item]
+        if not cell:
+            del self.cells[cell_key]
+
+    # called when an item has moved, only does work if it has left its cell
+    def update(self, item, xpos:float, ypos:float):
+        new_cell = self.get_cell(xpos, ypos)
+        old_cell = self.item_cells[item]
+        if new_cell != old_cell:
+            self._remove_from_cell(item, old_cell)
+            self.item_cells[item] = new_cell
+            self.cells.setdefault(new_cell, {})[item] = None
+
+    # returns all items that might intersect a circle at (xpos, ypos) with the given radius
+    def query(self, xpos:float, ypos:float, radius:float) -> list:
+        reach = radius + self.max_radius
+        min_x, min_y = self.get_cell(xpos - reach, ypos - reach)
+        max_x, max_y = self.get_cell(xpos + reach, ypos + reach)
+        candidates = []
+        for cell_x in range(min_x, max_x + 1):
+            for cell_y in range(min_y, max_y + 1):
+                cell = self.cells.get((cell_x, cell_y))
+                if cell:
+                    candidates.extend(cell)
+        return candidates
+
 class Circle ():
+    # the SpatialHashGrid the circle is stored in, if any
+    grid:SpatialHashGrid = None
+
     def __init__(self, xpos:float, ypos:float, radius:int):
         # the coordinates of the circle's center. Please avoid setting them directly, use the move() function.
         self.xpos = xpos
@@ -38,7 +206,7 @@ class Circle ():
 
         self.radius = radius
 
-        self.sprite = pyglet.shapes.Circle(xpos,ypos,radius, color =(255,0,255))
+        self.sprite = pyglet.shapes.Circle(xpos,ypos,radius, color =(255,0,255), batch=batch)
 
     def move(self, delta_x:float, delta_y:float, ignore_collision:bool=False):
         self.xpos  += delta_x
@@ -46,6 +214,8 @@ class Circle ():
         self.sprite.x = self.xpos
         self.sprite.y = self.ypos
         self.check_collision_with_wall()
+        if self.grid is not None:
+            self.grid.update(self, self.xpos, self.ypos)
     
     def check_collision_with_wall(self):
         if self.xpos - self.radius < 0:
@@ -87,8 +257,22 @@ class Circle ():
             #self.sprite.y = self.ypos
             #self.check_collision_with_wall()
 
-    def draw(self):
-        self.sprite.draw()
+    def add_to_grid(self, grid:SpatialHashGrid):
+        grid.insert(self, self.xpos, self.ypos, self.radius)
+        self.grid = grid
+
+    def remove_from_grid(self):
+        self.grid.remove(self)
+        self.grid = None
+
+    # returns the circles of the grid that intersect this circle
+    def get_collisions(self, grid:SpatialHashGrid) -> list:
+        return [other for other in grid.query(self.xpos, self.ypos, self.radius)
+                if other is not self and self.check_collision_with_circle(other)]
+
+    # removes the circle from the batch, so it is no longer drawn
+    def delete(self):
+        self.sprite.delete()
 
     def get_coordinates(self)-> tuple[float, float]:
         return self.xpos, self.ypos
@@ -105,12 +289,8 @@ class Head(Circle):
         self.radius:int = radius
         self.rotation:float = rotation
 
-        texture = pyglet.image.load(HEAD_TEXTURE_PATH)
-        #move texture's anchor point to the center
-        texture.anchor_x = texture.width//2
-        texture.anchor_y = texture.height//2
-
-        self.sprite = pyglet.sprite.Sprite(texture, x=xpos, y=ypos)
+        texture = resources.get_texture(HEAD_TEXTURE_PATH)
+        self.sprite = pyglet.sprite.Sprite(texture, x=xpos, y=ypos, batch=batch, group=HEAD_LAYER)
         global sprite_scale
         self.sprite.scale_x = sprite_scale
         self.sprite.scale_y = sprite_scale
@@ -118,7 +298,23 @@ class Head(Circle):
 
         self.velocity = np.array((0.0,0.0))
 
-        self.first_body_segment:BodySegment = None
+        self.body = SnakeBody()
+        self.save_state()
+
+    # remembers where the head was before a simulation step, for interpolating while rendering
+    def save_state(self):
+        self.previous_xpos:float = self.xpos
+        self.previous_ypos:float = self.ypos
+        self.previous_rotation:float = self.rotation
+        self.body.save_state()
+
+    # places the sprites between the state before and after the last simulation step
+    def update_sprites(self, alpha:float):
+        xpos = self.previous_xpos + (self.xpos - self.previous_xpos) * alpha
+        ypos = self.previous_ypos + (self.ypos - self.previous_ypos) * alpha
+        self.sprite.position = (xpos, ypos, self.sprite.z)
+        self.sprite.rotation = np.rad2deg(interpolate_angle(self.previous_rotation, self.rotation, alpha))
+        self.body.update_sprites(alpha)
     
     def move(self, delta_x:float, delta_y:float, ignore_collision:bool=False):
         DEADZONE:float = 0.15
@@ -132,8 +328,7 @@ class Head(Circle):
                 angle += np.pi
             self.rotation = angle
             self.sprite.rotation = np.rad2deg(angle)
-        if self.first_body_segment != None:
-            self.first_body_segment.place_tangentially_to(self)
+        self.body.follow(self.xpos, self.ypos, self.radius)
         
         drag_force = 0.5 * HEAD_DRAG * self.velocity
         self.velocity -= drag_force / HEAD_MASS
@@ -146,7 +341,7 @@ class Head(Circle):
 
     
     def add_segment(self):
-        if self.first_body_segment == None:
+        if len(self.body) == 0:
             distance = self.radius + BODY_SEGMENT_SIZE
             delta_x = np.sin(self.rotation) * -distance 
             delta_y = np.cos(self.rotation) * -distance 
@@ -154,110 +349,166 @@ class Head(Circle):
             #    delta_x *= -1
             #    delta_y *= -1
 
-            self.first_body_segment = BodySegment(self.xpos + delta_x, self.ypos + delta_y, BODY_SEGMENT_SIZE, self.rotation)
-        else:
-            self.first_body_segment.add_segment()
+            self.body.append(self.xpos + delta_x, self.ypos + delta_y, BODY_SEGMENT_SIZE, self.rotation)
+            return
 
-    def draw(self):
-        self.sprite.draw()
-        if self.first_body_segment != None:
-            self.first_body_segment.draw()
+        tail_xpos, tail_ypos = self.body.positions[len(self.body) - 1]
+        tail_radius = self.body.radii[len(self.body) - 1]
+        tail_rotation = self.body.rotations[len(self.body) - 1]
+        distance = tail_radius + BODY_SEGMENT_SIZE
+        delta_x = np.sin(tail_rotation) * -distance 
+        delta_y = np.cos(tail_rotation) * -distance 
+        if 0 < tail_rotation < np.pi:
+            delta_x *= -1
+            delta_y *= -1
+        rotation = tail_rotation
+
+        # place the new segment on the other side of the tail if it would overlap the body or the head
+        if self.body.collides_with(tail_xpos + delta_x, tail_ypos + delta_y, BODY_SEGMENT_SIZE, ignore=len(self.body) - 1):
+            delta_x *= -1
+            delta_y *= -1
+            rotation = (tail_rotation + np.pi) % (2*np.pi)
+        if euclidian((tail_xpos + delta_x, tail_ypos + delta_y), self.get_coordinates()) < BODY_SEGMENT_SIZE + self.radius:
+            delta_x *= -1
+            delta_y *= -1
+            rotation = (tail_rotation + np.pi) % (2*np.pi)
+        self.body.append(tail_xpos + delta_x, tail_ypos + delta_y, BODY_SEGMENT_SIZE, rotation)
+
+    def delete(self):
+        super().delete()
+        self.body.delete()
     
+    # the first segment always touches the head, so it is not checked
     def check_collision_with_head(self)->bool:
-        if self.first_body_segment != None:
-            return self.first_body_segment.check_collision_with_head(self)
-        else:
-            return False
-
-    # generator function to iterate through all body segments.
-    def get_all_body_segments(self):
-        current_segment = self.first_body_segment
-        while current_segment != None:
-            yield current_segment
-            current_segment = current_segment.next_segment
-
-
-
-class BodySegment(Circle):
-    def __init__(self, xpos:float, ypos:float, radius:int, rotation:float=0):
-        self.xpos:float = xpos
-        self.ypos:float = ypos
-        self.radius:int = radius
-        self.rotation:float = rotation #from -2*pi to 2*pi
-
-        texture = pyglet.image.load(BODY_TEXTURE_PATH)
-        #move texture's anchor point to the center
-        texture.anchor_x = texture.width//2
-        texture.anchor_y = texture.height//2
-
-        self.sprite = pyglet.sprite.Sprite(texture, x=xpos, y=ypos)
-        #self.sprite.width = self.radius*2
-        #self.sprite.height = self.radius*2
-
-        global sprite_scale
-        self.sprite.scale_x = sprite_scale
-        self.sprite.scale_y = sprite_scale
-
-        self.next_segment:BodySegment = None
-    
-    def draw(self):
-        self.sprite.draw()
-        if self.next_segment != None:
-            self.next_segment.draw()
-
-    def move(self, delta_x:float, delta_y:float, ignore_collision:bool=False):
-        
-        super().move(delta_x, delta_y)
-        try:
-            angle = np.arctan(delta_x / delta_y)
-        except ZeroDivisionError:
-            angle = np.pi/2
-        if delta_y > 0:
-            angle += np.pi
-        self.rotation = angle
-        self.sprite.rotation = np.rad2deg(angle)
-        if not ignore_collision:
-            for segment in gameManager.head.get_all_body_segments():
-                if not (segment is self.next_segment or segment.next_segment is self):
-                    if self.check_collision_with_circle(segment):
-                        self.place_tangentially_to(segment)
-        if self.next_segment == None:
+        return self.body.collides_with(self.xpos, self.ypos, self.radius, ignore=0)
+
+
+# the body of the snake as a structure of arrays instead of one object per segment.
+# segment 0 hangs on the head, the last segment is the tail.
+# the arrays grow by doubling, so adding a segment is cheap on average.
+class SnakeBody():
+    def __init__(self, capacity:int=SNAKE_BODY_INITIAL_CAPACITY):
+        self.count:int = 0
+        self.positions = np.zeros((capacity, 2))
+        self.rotations = np.zeros(capacity) #from -2*pi to 2*pi
+        self.radii = np.zeros(capacity)
+        # state before the last simulation step, for interpolating while rendering
+        self.previous_count:int = 0
+        self.previous_positions = np.zeros((capacity, 2))
+        self.previous_rotations = np.zeros(capacity)
+        self.sprites:list[pyglet.sprite.Sprite] = []
+        # the segments are stored by their number
+        self.grid = SpatialHashGrid()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _grow(self):
+        capacity = 2 * len(self.radii)
+        positions = np.zeros((capacity, 2))
+        positions[:self.count] = self.positions[:self.count]
+        rotations = np.zeros(capacity)
+        rotations[:self.count] = self.rotations[:self.count]
+        radii = np.zeros(capacity)
+        radii[:self.count] = self.radii[:self.count]
+        self.positions, self.rotations, self.radii = positions, rotations, radii
+        previous_positions = np.zeros((capacity, 2))
+        previous_positions[:self.previous_count] = self.previous_positions[:self.previous_count]
+        previous_rotations = np.zeros(capacity)
+        previous_rotations[:self.previous_count] = self.previous_rotations[:self.previous_count]
+        self.previous_positions, self.previous_rotations = previous_positions, previous_rotations
+
+    def append(self, xpos:float, ypos:float, radius:int, rotation:float=0):
+        if self.count == len(self.radii):
+            self._grow()
+        index = self.count
+        self.positions[index] = xpos, ypos
+        self.rotations[index] = rotation
+        self.radii[index] = radius
+
+        # all segments share one texture, so the batch draws them in one go
+        self.sprites.append(body_sprites.acquire(xpos, ypos))
+
+        self.grid.insert(index, xpos, ypos, radius)
+        self.count += 1
+
+    # checks whether a circle intersects any segment except the one with the number ignore
+    def collides_with(self, xpos:float, ypos:float, radius:float, ignore:int=None) -> bool:
+        for index in self.grid.query(xpos, ypos, radius):
+            if index != ignore:
+                if euclidian((xpos, ypos), self.positions[index]) < radius + self.radii[index]:
+                    return True
+        return False
+
+    # pulls the body behind the head: each segment is moved towards the one in front of it
+    # until they touch, and turned in the direction it was moved.
+    def follow(self, head_xpos:float, head_ypos:float, head_radius:float):
+        if self.count == 0:
             return
-        self.next_segment.place_tangentially_to(self)
-
-    def add_segment(self):
-        if self.next_segment != None:
-            self.next_segment.add_segment()
-        else:
-            distance = self.radius + BODY_SEGMENT_SIZE
-            delta_x = np.sin(self.rotation) * -distance 
-            delta_y = np.cos(self.rotation) * -distance 
-            if 0 < self.rotation < np.pi:
-                delta_x *= -1
-                delta_y *= -1
-            
-            self.next_segment = BodySegment(self.xpos + delta_x, self.ypos + delta_y, BODY_SEGMENT_SIZE, self.rotation)
-            for segment in gameManager.head.get_all_body_segments():
-                if not segment is self and not segment is self.next_segment:
-                    if self.next_segment.check_collision_with_circle(segment):
-                        delta_x *= -1
-                        delta_y *= -1
-                        self.next_segment = BodySegment(self.xpos + delta_x, self.ypos + delta_y, BODY_SEGMENT_SIZE, (self.rotation + np.pi) % (2*np.pi))
-                        break
-            if self.next_segment.check_collision_with_circle(gameManager.head):
-                delta_x *= -1
-                delta_y *= -1
-                self.next_segment = BodySegment(self.xpos + delta_x, self.ypos + delta_y, BODY_SEGMENT_SIZE, (self.rotation + np.pi) % (2*np.pi))
-                        
-
-    def check_collision_with_head(self, head:Head):
-        if not head.first_body_segment is self:
-            if self.check_collision_with_circle(head):
-                return True
-        if self.next_segment == None:
-            return False
-        else:
-            return self.next_segment.check_collision_with_head(head)
+        # plain floats are much faster than numpy scalars for one value at a time
+        positions = self.positions[:self.count].tolist()
+        radii = self.radii[:self.count].tolist()
+        rotations = self.rotations[:self.count].tolist()
+        width, height = window.width, window.height
+        other_xpos, other_ypos, other_radius = float(head_xpos), float(head_ypos), float(head_radius)
+        moved = 0
+        for index in range(self.count):
+            xpos, ypos = positions[index]
+            radius = radii[index]
+            current_delta_x = xpos - other_xpos
+            current_delta_y = ypos - other_ypos
+            distance = math.sqrt(current_delta_x ** 2 + current_delta_y ** 2)
+            if distance <= 0:
+                # the segment cannot tell which way to go, so the rest of the body stays too
+                break
+            distance_to_move = distance - (other_radius + radius)
+            delta_x = -current_delta_x / distance * distance_to_move
+            delta_y = -current_delta_y / distance * distance_to_move
+            xpos = min(max(xpos + delta_x, radius), width - radius)
+            ypos = min(max(ypos + delta_y, radius), height - radius)
+            if delta_y != 0:
+                angle = math.atan(delta_x / delta_y)
+            else:
+                angle = math.pi/2
+            if delta_y > 0:
+                angle += math.pi
+            positions[index] = (xpos, ypos)
+            rotations[index] = angle
+            other_xpos, other_ypos, other_radius = xpos, ypos, radius
+            moved += 1
+        if moved == 0:
+            return
+        self.positions[:moved] = positions[:moved]
+        self.rotations[:moved] = rotations[:moved]
+        # the sprites are moved when rendering
+        for index in range(moved):
+            xpos, ypos = positions[index]
+            self.grid.update(index, xpos, ypos)
+
+    def save_state(self):
+        self.previous_positions[:self.count] = self.positions[:self.count]
+        self.previous_rotations[:self.count] = self.rotations[:self.count]
+        self.previous_count = self.count
+
+    # places the sprites between the state before and after the last simulation step.
+    # segments added during the step are shown where they are now
+    def update_sprites(self, alpha:float):
+        positions = self.positions[:self.count].copy()
+        rotations = self.rotations[:self.count].copy()
+        interpolated = min(self.previous_count, self.count)
+        previous_positions = self.previous_positions[:interpolated]
+        previous_rotations = self.previous_rotations[:interpolated]
+        positions[:interpolated] = previous_positions + (positions[:interpolated] - previous_positions) * alpha
+        rotations[:interpolated] = interpolate_angle(previous_rotations, rotations[:interpolated], alpha)
+        for sprite, (xpos, ypos), rotation in zip(self.sprites, positions.tolist(), np.rad2deg(rotations).tolist()):
+            sprite.position = (xpos, ypos, sprite.z)
+            sprite.rotation = rotation
+
+    # the sprites go back to the pool for the next snake
+    def delete(self):
+        for sprite in self.sprites:
+            body_sprites.release(sprite)
+        self.sprites.clear()
     
 class Food(Circle):
 
@@ -265,36 +516,40 @@ class Food(Circle):
         self.xpos:float = xpos
         self.ypos:float = ypos
         self.radius:float = radius
-        texture = pyglet.image.load(FOOD_TEXTURE_PATH)
-        texture.anchor_x = texture.width//2
-        texture.anchor_y = texture.height//2
-        self.sprite = pyglet.sprite.Sprite(texture, x=xpos, y=ypos)
+        self.sprite = food_sprites.acquire(xpos, ypos)
         #self.sprite.width = self.radius*2
         #self.sprite.height = self.radius*2
-        global sprite_scale
-        self.sprite.scale_x = sprite_scale
-        self.sprite.scale_y = sprite_scale
+
+    def delete(self):
+        food_sprites.release(self.sprite)
 
 PORT:int = 5700
+# weight of new accelerometer values, lower values smooth out jitter but react slower
+SENSOR_SMOOTHING:float = 0.5
 sensor = SensorUDP(PORT)
+sensor.add_filter('accelerometer', ExponentialSmoothing(SENSOR_SMOOTHING))
 
 def get_sensor_data():
-    if sensor.has_capability('accelerometer'):
+    # read all axes from the same update of the sensor
+    accelerometer = sensor.snapshot().values.get('accelerometer')
+    if accelerometer:
         strength = -5
-        acc_x = np.sin(sensor.get_value('accelerometer')['x']) * strength
-        acc_y = np.sin(sensor.get_value('accelerometer')['y']) * strength
+        acc_x = np.sin(accelerometer['x']) * strength
+        acc_y = np.sin(accelerometer['y']) * strength
         gameManager.handle_movement(acc_x, acc_y)
 
 class GameManager():
     def __init__(self):
         self.init_background()
+        self.head:Head = None
+        self.foods:list[Food] = []
         self.reset()
-        self.score_label = pyglet.text.Label(f"Score: {self.score}", font_name="Cooper", x=SCORE_LABEL_XPOS, y=SCORE_LABEL_YPOS, font_size=SCORE_LABEL_SIZE)
+        self.score_label = pyglet.text.Label(f"Score: {self.score}", font_name="Cooper", x=SCORE_LABEL_XPOS, y=SCORE_LABEL_YPOS, font_size=SCORE_LABEL_SIZE,
+                                             batch=batch, group=UI_LAYER)
         self.paused:bool = False
 
     def init_background(self):
-        self.background_image = pyglet.image.load(BACKGROUND_TEXTURE_PATH)
-        self.background_batch = pyglet.graphics.Batch()
+        self.background_image = resources.get_texture(BACKGROUND_TEXTURE_PATH, centered=False)
         self.background_sprites = []
         
         num_rows:int = math.ceil(window.height / self.background_image.height)
@@ -303,16 +558,22 @@ class GameManager():
             for j in range(num_cols):
                 xpos = j * self.background_image.width
                 ypos = i * self.background_image.height
-                self.background_sprites.append(pyglet.sprite.Sprite(self.background_image, x=xpos, y=ypos, batch=self.background_batch))
+                self.background_sprites.append(pyglet.sprite.Sprite(self.background_image, x=xpos, y=ypos, batch=batch, group=BACKGROUND_LAYER))
 
-    def draw_background(self):
-        self.background_batch.draw()
-    
-    def draw_UI(self):
-        self.score_label.text = f"Score: {self.score}"
-        self.score_label.draw()
+    def update_UI(self):
+        text = f"Score: {self.score}"
+        # changing the text lays out the label again, so it is only done when needed
+        if self.score_label.text != text:
+            self.score_label.text = text
 
     def reset(self):
+        # remove the old snake and food from the batch
+        if self.head is not None:
+            self.head.delete()
+        for food in self.foods:
+            food.delete()
+        # the snake body has a grid of its own
+        self.food_grid = SpatialHashGrid()
         self.head = Head(window.width/2, window.height/2, HEAD_SIZE)
         self.foods:list[Food] = []
         self.score:int = 0
@@ -325,20 +586,19 @@ class GameManager():
         self.check_food()
 
 
-    def render(self):
-        self.draw_background()
-        for food in self.foods:
-            food.draw()
-            
-        self.head.draw()
-        
-        self.draw_UI()
+    # background, food, body, head and UI are all in the batch.
+    # alpha is how far the game is between the last simulation step and the next one
+    def render(self, alpha:float=1.0):
+        self.head.update_sprites(alpha)
+        self.update_UI()
+        batch.draw()
 
     def spawn_food(self):
         xpos:int = random.randrange(FOOD_SIZE, window.width-FOOD_SIZE)
         ypos:int = random.randrange(FOOD_SIZE, window.height-FOOD_SIZE)
         food = Food(xpos, ypos, FOOD_SIZE)
         self.foods.append(food)
+        food.add_to_grid(self.food_grid)
 
     def handle_movement(self,acc_x:float, acc_y:float):
         if self.paused:
@@ -353,13 +613,14 @@ class GameManager():
         self.head.apply_force(delta_x, delta_y)
     
     def check_food(self):
-        for food in self.foods:
-            if self.head.check_collision_with_circle(food):
-                self.score += 1
-                self.foods.remove(food)
-                self.spawn_food()
-                self.head.add_segment()
-                break
+        for food in self.head.get_collisions(self.food_grid):
+            self.score += 1
+            self.foods.remove(food)
+            food.remove_from_grid()
+            food.delete()
+            self.spawn_food()
+            self.head.add_segment()
+            break
     
     def check_snake_eats_itself(self):
         if self.head.check_collision_with_head():
@@ -368,8 +629,47 @@ class GameManager():
             #self.paused = True
 
 
+# runs a step function at a fixed rate, however often it is called by pyglet.clock.
+# the time that has passed is collected in an accumulator and used up in whole steps,
+# the rest is carried over to the next call.
+class FixedTimestep():
+    def __init__(self, step_function, rate:float=SIMULATION_RATE, max_steps:int=MAX_STEPS_PER_FRAME):
+        self.step_function = step_function
+        self.step_duration:float = 1 / rate
+        self.max_steps:int = max_steps
+        self.accumulator:float = 0.0
+        self.dropped_steps:int = 0
+        self._last_advance:float = time.perf_counter()
+
+    # to be scheduled with pyglet.clock, dt is the time since the last call
+    def advance(self, dt:float):
+        self.accumulator += dt
+        steps = 0
+        while self.accumulator >= self.step_duration:
+            if steps == self.max_steps:
+                dropped = int(self.accumulator // self.step_duration)
+                self.dropped_steps += dropped
+                self.accumulator -= dropped * self.step_duration
+                break
+            self.step_function()
+            self.accumulator -= self.step_duration
+            steps += 1
+        self._last_advance = time.perf_counter()
+
+    # how far the game is between the last step and the next one, from 0 to 1
+    def get_alpha(self) -> float:
+        elapsed = self.accumulator + time.perf_counter() - self._last_advance
+        return min(elapsed / self.step_duration, 1.0)
+
 gameManager = GameManager()
 
+def simulation_step():
+    gameManager.head.save_state()
+    get_sensor_data()
+    gameManager.update()
+
+simulation = FixedTimestep(simulation_step)
+
 @window.event
 def on_key_press(symbol, modifiers):
     rate_acc = 0.5
@@ -390,9 +690,8 @@ def on_key_press(symbol, modifiers):
 
 @window.event
 def on_draw():
-    get_sensor_data()
-    gameManager.update()
     window.clear()
-    gameManager.render()
-    
-pyglet.app.run()
+    gameManager.render(simulation.get_alpha())
+
+pyglet.clock.schedule_interval(simulation.advance, 1 / SIMULATION_RATE)
+pyglet.app.run(1 / RENDER_RATE)
@@ -1,19 +1,28 @@
 import socket 
 import time
+import threading
 import json
 import random, math
+from collections import namedtuple
+import numpy as np
+from DIPPID import encode_binary_frame
 
 
 SIN_LAYERS = 8000
 
+# set to an int to generate the same values on every run, see initialize_random_values()
+SEED = None
+
 BUTTON_THRESHOLD:float = 0.75
-ACCEL_OFFSET_X:float = random.randint(0, 65536)
-ACCEL_OFFSET_Y:float = random.randint(0, 65536)
-ACCEL_OFFSET_Z:float = random.randint(0, 65536)
 
 ACCEL_SPEED = 0.5
 ACCEL_BIAS = 0.1
 
+GYRO_SPEED = 0.8
+GYRO_BIAS = 0.2
+
+GRAVITY_SPEED = 0.1
+GRAVITY_BIAS = 1.0
 
 BUTTON_SPEED = 7
 BUTTON_BIAS = 1.0
@@ -21,86 +30,430 @@ BUTTON_BIAS = 1.0
 AMPLITUDE_BIAS = 1.2
 FREQUENCY_EXPONENT = 3.6
 FREQUENCY_BIAS = 0.00003
-#chooses the right function for the job.
-def get_value(capability:str, time:float):
-    if capability == "accelerometer":
-        return get_value_accelerometer(time)
-    elif capability == "button_1":
-        return get_value_button(time)
-
-#generates accelerometer data
-def get_value_accelerometer (time:float):
-
-    
-
-    values = {}
-    values["x"] = get_layered_sin_value(time, ACCEL_OFFSET_X, ACCEL_SPEED, ACCEL_BIAS)
-    values["y"] = get_layered_sin_value(time, ACCEL_OFFSET_Y, ACCEL_SPEED, ACCEL_BIAS)
-    values["z"] = get_layered_sin_value(time, ACCEL_OFFSET_Z, ACCEL_SPEED, ACCEL_BIAS)
-    return values
 
-#generates button data
-def get_value_button(time:float):
-    value = get_layered_sin_value(time, speed=BUTTON_SPEED, bias=BUTTON_BIAS)
-    if value > BUTTON_THRESHOLD:
-        return 1
-    else:
-        return 0
-
-def generate_values(time:float):
-    
-    measures = {}
-    for capability in capabilities:
-        value = get_value(capability, time)
-        measures[capability] = value
-    return measures
+# send compact binary frames (see DIPPID.py) instead of json text.
+# SensorUDP detects the format automatically.
+USE_BINARY_FORMAT:bool = False
+
+# messages per second (up to 1000)
+SEND_RATE:float = 100
+# what to do when sending falls behind:
+# "catch_up" sends the missed messages as fast as possible,
+# "skip" drops them and continues with the next deadline
+LATE_POLICY:str = "skip"
+# the last part of each wait is spent busy-waiting, as sleep() often oversleeps
+SPIN_TIME:float = 0.0005
+# seconds between reports of the measured rate and jitter (0 disables them)
+REPORT_INTERVAL:float = 5.0
+# printing every message slows the sender down noticeably at high rates
+PRINT_MESSAGES:bool = True
+
+# generate the values in blocks ahead of time in a worker thread,
+# so the send loop only has to pick them up
+GENERATE_AHEAD:bool = True
+# seconds of values generated at once
+BLOCK_DURATION:float = 1.0
+# blocks that are kept ready for the send loop
+BLOCKS_AHEAD:int = 2
+# limits the memory for the phases of one computation step (number of float64 values)
+MAX_PHASES_PER_STEP:int = 1 << 21
+
+# describes how the sender generates a capability.
+# fields: names of the values of a capability that sends a dict (e.g. x, y, z), or None for a single value.
+# kind: "analog" sends the layered sine, "button" sends 1 while the layered sine is above
+# BUTTON_THRESHOLD and "counter" sends the number of the message.
+# offsets: where in the layered sine each value starts, so values differ from each other
+CapabilityGenerator = namedtuple("CapabilityGenerator", ("name", "fields", "kind", "speed", "bias", "offsets"))
+
+CAPABILITY_KINDS = ("analog", "button", "counter")
+CAPABILITY_GENERATORS = {}
+# draws the offsets of all capabilities except accelerometer and button_1,
+# so adding a capability does not change the values of the others
+_capability_random = random.Random()
+
+def register_capability(name:str, fields:tuple=None, kind:str="analog", speed:float=1.0, bias:float=1.0):
+    if kind not in CAPABILITY_KINDS:
+        raise ValueError(f"unknown kind of capability: {kind}")
+    if kind != "analog" and fields is not None:
+        raise ValueError("only analog capabilities can have fields")
+    fields = tuple(fields) if fields is not None else None
+    offsets = _draw_offsets(name, fields, kind)
+    CAPABILITY_GENERATORS[name] = CapabilityGenerator(name, fields, kind, speed, bias, offsets)
+    _layouts.clear()
+
+# accelerometer and button_1 were the only capabilities before the registry.
+# their offsets are drawn as back then, so a seed still generates the same values
+def _draw_offsets(name:str, fields:tuple, kind:str) -> tuple:
+    if kind == "counter":
+        return ()
+    if name == "accelerometer":
+        return tuple(random.randint(0, 65536) for field in fields)
+    if name == "button_1":
+        return (0,)
+    return tuple(_capability_random.randint(0, 65536) for field in (fields or (None,)))
+
+# quotes a name for the message template of MessageLayout
+def _quote(name:str) -> str:
+    return json.dumps(name).replace("%", "%%")
+
+# the values of the capabilities of a message in one flat array: a layered sine channel per
+# analog value and button, followed by the message counter. a message is built from this array
+# in one step, so each additional capability costs almost nothing per message.
+class MessageLayout():
+    def __init__(self, capabilities:list[str]):
+        offsets, speeds, biases = [], [], []
+        button_channels = []
+        # index into the flat array and format of each value, in the order of the message
+        order = []
+        parts = []
+        # (name, fields, kind) of each capability for building dicts
+        self._structure = []
+        generators = []
+        for name in capabilities:
+            if name not in CAPABILITY_GENERATORS:
+                raise ValueError(f"unknown capability: {name}")
+            generators.append(CAPABILITY_GENERATORS[name])
+        channel_count = sum(len(generator.offsets) for generator in generators)
+        for generator in generators:
+            if generator.kind == "counter":
+                order.append(channel_count)
+                parts.append(f"{_quote(generator.name)}: %d")
+            elif generator.kind == "button":
+                button_channels.append(len(offsets))
+                order.append(len(offsets))
+                parts.append(f"{_quote(generator.name)}: %d")
+            else:
+                value_formats = []
+                for field in (generator.fields or (None,)):
+                    order.append(len(offsets) + len(value_formats))
+                    value_formats.append("%r" if field is None else f"{_quote(field)}: %r")
+                if generator.fields is None:
+                    parts.append(f"{_quote(generator.name)}: %r")
+                else:
+                    parts.append(f"{_quote(generator.name)}: {{{', '.join(value_formats)}}}")
+            for offset in generator.offsets:
+                offsets.append(offset)
+                speeds.append(generator.speed)
+                biases.append(generator.bias)
+            self._structure.append((generator.name, generator.fields, generator.kind))
+        self.capabilities = tuple(capabilities)
+        self.offsets = np.array(offsets, dtype=float)
+        self.speeds = np.array(speeds, dtype=float)
+        self.biases = np.array(biases, dtype=float)
+        self._button_channels = np.array(button_channels, dtype=int)
+        self._order = np.array(order, dtype=int)
+        # same output as json.dumps, which also uses repr() for floats
+        self._template = "{" + ", ".join(parts) + "}"
+        self._values = np.zeros(channel_count + 1)
+
+    # returns the values of the message in order, buttons as 0 or 1
+    def get_values(self, channel_values:np.ndarray, counter:int=0) -> list:
+        values = self._values
+        values[:-1] = channel_values
+        values[-1] = counter
+        values[self._button_channels] = values[self._button_channels] > BUTTON_THRESHOLD
+        return values[self._order].tolist()
+
+    def to_json(self, channel_values:np.ndarray, counter:int=0) -> str:
+        return self._template % tuple(self.get_values(channel_values, counter))
+
+    def to_measures(self, channel_values:np.ndarray, counter:int=0) -> dict:
+        values = iter(self.get_values(channel_values, counter))
+        measures = {}
+        for name, fields, kind in self._structure:
+            if fields is not None:
+                measures[name] = {field: next(values) for field in fields}
+            elif kind == "analog":
+                measures[name] = next(values)
+            else:
+                measures[name] = int(next(values))
+        return measures
+
+_layouts = {}
+
+# layouts are cached, as building one is slow compared to using it
+def get_layout(capabilities:list[str]=None) -> MessageLayout:
+    if capabilities is None:
+        capabilities = CAPABILITIES
+    key = tuple(capabilities)
+    if key not in _layouts:
+        _layouts[key] = MessageLayout(key)
+    return _layouts[key]
+
+register_capability("accelerometer", ("x", "y", "z"), speed=ACCEL_SPEED, bias=ACCEL_BIAS)
+register_capability("gyroscope", ("x", "y", "z"), speed=GYRO_SPEED, bias=GYRO_BIAS)
+register_capability("gravity", ("x", "y", "z"), speed=GRAVITY_SPEED, bias=GRAVITY_BIAS)
+for button_number in range(1, 5):
+    register_capability(f"button_{button_number}", kind="button", speed=BUTTON_SPEED, bias=BUTTON_BIAS)
+register_capability("heartbeat", kind="counter")
+
+# counter is the number of the message, it is sent by counter capabilities such as heartbeat
+def generate_values(time:float, capabilities:list[str]=None, counter:int=0):
+    layout = get_layout(capabilities)
+    # all channels are evaluated in one go
+    channel_values = get_layered_sin_values(time, layout.offsets, layout.speeds, layout.biases)
+    return layout.to_measures(channel_values, counter)
+
+# evaluates the layered sine for several channels at once.
+# offsets, speeds and biases contain one value per channel
+def get_layered_sin_values(time:float, offsets:np.ndarray, speeds:np.ndarray, biases:np.ndarray) -> np.ndarray:
+    channel_times = time * speeds + offsets
+    # one row per channel, one column per layer
+    phases = np.outer(channel_times, sin_frequencies) + sin_shifts
+    return np.sin(phases) @ sin_amplitudes * biases
+
+# evaluates the layered sine for many points in time at once.
+# returns one row per point in time and one column per channel
+def get_layered_sin_block(times:np.ndarray, offsets:np.ndarray, speeds:np.ndarray, biases:np.ndarray) -> np.ndarray:
+    values = np.empty((len(times), len(offsets)))
+    # the phases of all layers are large, so they are computed a few rows at a time
+    rows_per_step = max(1, MAX_PHASES_PER_STEP // max(1, len(offsets) * len(sin_frequencies)))
+    for start in range(0, len(times), rows_per_step):
+        channel_times = np.multiply.outer(times[start:start + rows_per_step], speeds) + offsets
+        phases = np.multiply.outer(channel_times, sin_frequencies) + sin_shifts
+        values[start:start + rows_per_step] = np.sin(phases) @ sin_amplitudes * biases
+    return values
 
 def get_layered_sin_value(time:float, offset:float=0, speed:float=1.0, bias:float=1.0):
-    value = 0
-    time = time * speed
-    for fractal_sin in sin_functions:
-        value += fractal_sin(time+offset)
-    return value * bias
+    return float(get_layered_sin_values(time, np.array((offset,)), np.array((speed,)), np.array((bias,)))[0])
 
+# draws frequency and shift of each layer one after another,
+# so a seeded run always generates the same layers
 def initialize_randomizer_values(sin_layers:int):
+    global sin_frequencies, sin_shifts, sin_amplitudes
+    frequencies = []
+    shifts = []
     for i in range(sin_layers):
-        
-        #amplitude = 1/((i+2))#*AMPLITUDE_BIAS)
-        #amplitude = 1/sin_layers
-        amplitude = 1/math.log(sin_layers)
-        frequency = random.random() * (i+1) * FREQUENCY_BIAS
-        x_shift = random.random() * 2 * math.pi
-        layered_sin_function = lambda x : math.sin( frequency * x + x_shift) * amplitude
-        sin_functions.append(layered_sin_function)
-sin_functions = []
+        frequencies.append(random.random() * (i+1) * FREQUENCY_BIAS)
+        shifts.append(random.random() * 2 * math.pi)
+    sin_frequencies = np.array(frequencies)
+    sin_shifts = np.array(shifts)
+    #amplitude = 1/((i+2))#*AMPLITUDE_BIAS)
+    #amplitude = 1/sin_layers
+    sin_amplitudes = np.full(sin_layers, 1/math.log(sin_layers))
 
-initialize_randomizer_values(SIN_LAYERS)
+sin_frequencies = np.zeros(0)
+sin_shifts = np.zeros(0)
+sin_amplitudes = np.zeros(0)
 
-IP = '127.0.0.1'
-PORT = 5700
+# draws the offsets of all registered capabilities and the sine layers.
+# with a seed, every run (and every process) generates the same values
+def initialize_random_values(seed:int=None, sin_layers:int=SIN_LAYERS):
+    global _capability_random
+    if seed is not None:
+        random.seed(seed)
+    # the accelerometer offsets are drawn before the sine layers, as they were before
+    accelerometer = CAPABILITY_GENERATORS.get("accelerometer")
+    if accelerometer is not None:
+        CAPABILITY_GENERATORS["accelerometer"] = accelerometer._replace(
+            offsets=_draw_offsets(accelerometer.name, accelerometer.fields, accelerometer.kind))
+    initialize_randomizer_values(sin_layers)
+    # seeded from random, as random.Random(seed) would repeat the accelerometer offsets
+    _capability_random = random.Random(random.getrandbits(64))
+    for name, generator in CAPABILITY_GENERATORS.items():
+        if name != "accelerometer":
+            CAPABILITY_GENERATORS[name] = generator._replace(offsets=_draw_offsets(name, generator.fields, generator.kind))
+    _layouts.clear()
+
+initialize_random_values(SEED)
+
+# waits for deadlines that lie exactly 1/rate apart.
+# the deadlines are computed from the start time and never from the time
+# a message was actually sent, so delays do not add up over time.
+class RateScheduler():
+    LATE_POLICIES = ("catch_up", "skip")
+
+    def __init__(self, rate:float, late_policy:str="skip", spin_time:float=SPIN_TIME):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        if late_policy not in self.LATE_POLICIES:
+            raise ValueError(f"unknown late policy: {late_policy}")
+        self.rate = rate
+        self.interval = 1 / rate
+        self.late_policy = late_policy
+        self.spin_time = spin_time
+        self.start_time = time.perf_counter()
+        self._tick = 0
+        # number of the tick the last call of wait() returned
+        self.tick = -1
+        self._skipped = 0
+        self._reset_report(self.start_time)
+
+    def _reset_report(self, now:float):
+        self._report_start = now
+        self._report_ticks = 0
+        self._report_skipped = 0
+        # running mean, sum of squared deviations (Welford) and max of the lateness,
+        # so long runs do not keep every tick in memory
+        self._lateness_mean = 0.0
+        self._lateness_m2 = 0.0
+        self._lateness_max = 0.0
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # blocks until the next deadline and returns it in seconds since start.
+    # the returned time advances by exactly 1/rate, unless ticks are skipped.
+    def wait(self) -> float:
+        deadline = self.start_time + self._tick * self.interval
+        now = time.perf_counter()
+        if now - deadline >= self.interval and self.late_policy == "skip":
+            # at least one full interval late: drop the missed ticks
+            missed = int((now - deadline) / self.interval)
+            self._tick += missed
+            self._skipped += missed
+            self._report_skipped += missed
+            deadline += missed * self.interval
+        remaining = deadline - now
+        if remaining > self.spin_time:
+            time.sleep(remaining - self.spin_time)
+        while time.perf_counter() < deadline:
+            pass
+        self._report_ticks += 1
+        lateness = time.perf_counter() - deadline
+        delta = lateness - self._lateness_mean
+        self._lateness_mean += delta / self._report_ticks
+        self._lateness_m2 += delta * (lateness - self._lateness_mean)
+        self._lateness_max = max(self._lateness_max, lateness)
+        self.tick = self._tick
+        self._tick += 1
+        return deadline - self.start_time
 
-capabilities = ["accelerometer", "button_1"]
+    def get_skipped_count(self) -> int:
+        return self._skipped
 
-persistent_data = {}
+    # returns measured rate, mean and max lateness and jitter (standard deviation
+    # of the lateness) since the last call, and starts a new measurement
+    def report(self) -> dict:
+        now = time.perf_counter()
+        elapsed = now - self._report_start
+        report = {
+            "rate": self._report_ticks / elapsed if elapsed > 0 else 0.0,
+            "target_rate": self.rate,
+            "skipped": self._report_skipped,
+            "mean_lateness": self._lateness_mean,
+            "max_lateness": self._lateness_max,
+            "jitter": math.sqrt(self._lateness_m2 / self._report_ticks) if self._report_ticks else 0.0,
+        }
+        self._reset_report(now)
+        return report
 
-if "accelerometer" in capabilities:
-    persistent_data["accel_from_point"] = None 
-    persistent_data["accel_to_point"] = None
-    persistent_data["accel_move_speed"] = 0
-    persistent_data["accel_time_movement_start"] = 0
-    pass
+def format_report(report:dict) -> str:
+    return (f"rate {report['rate']:.1f}/{report['target_rate']:g} Hz, "
+            f"jitter {report['jitter'] * 1000000:.0f} us, "
+            f"mean lateness {report['mean_lateness'] * 1000000:.0f} us, "
+            f"max lateness {report['max_lateness'] * 1000000:.0f} us, "
+            f"skipped {report['skipped']}")
 
-timestamp_begin = time.time()
-while True:
-    time_since_initialization = time.time() - timestamp_begin
-    measures = generate_values(time_since_initialization)
-    message = json.dumps(measures)
-    print(message)
-    
-    sock.sendto(message.encode(), (IP, PORT))
-    time.sleep(0.01)
+# generates the channel values of a MessageLayout for the ticks of a RateScheduler ahead of time.
+# a worker thread fills a ring buffer block by block, the send loop takes
+# the values out with get(). ticks the send loop skips are never generated.
+class SampleStream():
+    def __init__(self, rate:float, layout:MessageLayout, block_duration:float=BLOCK_DURATION, blocks_ahead:int=BLOCKS_AHEAD):
+        self.rate = rate
+        self.layout = layout
+        self.block_size = max(1, int(rate * block_duration))
+        # a whole number of blocks, so no block wraps around the end of the buffer
+        self.capacity = self.block_size * max(1, blocks_ahead)
+        self._buffer = np.empty((self.capacity, len(layout.offsets)))
+        # ticks [_consumed, _produced) are in the buffer
+        self._produced = 0
+        self._consumed = 0
+        self._underruns = 0
+        self._running = True
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
 
+    def _produce(self):
+        while True:
+            with self._condition:
+                while self._running and self._produced + self.block_size - self._consumed > self.capacity:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                # continue after ticks the send loop has skipped
+                start = max(self._produced, self._consumed)
+            block_start = start % self.capacity
+            # stop at the end of the buffer, the next block starts at the beginning
+            count = min(self.block_size, self.capacity - block_start)
+            ticks = np.arange(start, start + count)
+            # computed without holding the lock, numpy releases the GIL for most of it
+            self._buffer[block_start:block_start + count] = get_layered_sin_block(ticks / self.rate, self.layout.offsets, self.layout.speeds, self.layout.biases)
+            with self._condition:
+                self._produced = start + count
+                self._condition.notify_all()
 
+    # returns the channel values of the given tick. ticks must not decrease,
+    # the values of all earlier ticks are discarded
+    def get(self, tick:int) -> np.ndarray:
+        with self._condition:
+            self._consumed = tick
+            self._condition.notify_all()
+            if tick >= self._produced:
+                # the worker could not keep up
+                self._underruns += 1
+                while tick >= self._produced and self._running:
+                    self._condition.wait()
+            values = self._buffer[tick % self.capacity].copy()
+            self._consumed = tick + 1
+            self._condition.notify_all()
+            return values
+
+    # blocks until the first block is generated
+    def wait_until_ready(self):
+        with self._condition:
+            while self._produced == 0 and self._running:
+                self._condition.wait()
+
+    def get_underrun_count(self) -> int:
+        return self._underruns
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join()
+
+IP = '127.0.0.1'
+PORT = 5700
+
+# any of CAPABILITY_GENERATORS, in the order they are sent
+CAPABILITIES = ["accelerometer", "button_1"]
+
+def main():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    layout = get_layout(CAPABILITIES)
+    stream = None
+    if GENERATE_AHEAD:
+        stream = SampleStream(SEND_RATE, layout)
+        stream.wait_until_ready()
+    scheduler = RateScheduler(SEND_RATE, LATE_POLICY)
+    next_report = REPORT_INTERVAL
+    message_count = 0
+    while True:
+        time_since_initialization = scheduler.wait()
+        if stream is not None:
+            channel_values = stream.get(scheduler.tick)
+        else:
+            channel_values = get_layered_sin_values(time_since_initialization, layout.offsets, layout.speeds, layout.biases)
+        if USE_BINARY_FORMAT:
+            measures = layout.to_measures(channel_values, message_count)
+            if PRINT_MESSAGES:
+                print(measures)
+            message = encode_binary_frame(measures)
+        else:
+            message = layout.to_json(channel_values, message_count)
+            if PRINT_MESSAGES:
+                print(message)
+            message = message.encode()
+        
+        sock.sendto(message, (IP, PORT))
+        message_count += 1
+        if REPORT_INTERVAL > 0 and time_since_initialization >= next_report:
+            report = format_report(scheduler.report())
+            if stream is not None:
+                report += f", generator underruns {stream.get_underrun_count()}"
+            print(report)
+            next_report += REPORT_INTERVAL
 
+# load_generator.py imports this file, so the sender only starts when run directly
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,26 @@
 import sys
 import json
-from threading import Thread
-from time import sleep
+import struct
+import operator
+import asyncio
+from collections import deque, namedtuple
+from types import MappingProxyType
+from threading import Thread, Condition, Event, Lock, current_thread
+from time import sleep, monotonic, perf_counter, time
 from datetime import datetime
 import signal
+import traceback
 
 # those modules are imported dynamically during runtime
 # they are imported only if the corresponding class is used
 #import socket
+#import selectors
+#import mmap
 #import serial
 #import wiimote
+#import numpy
+#import orjson
+#import ujson
 
 class Sensor():
     # class variable that stores all instances of Sensor
@@ -20,8 +31,35 @@ class Sensor():
         self._capabilities = []
         # for each capability, store a list of callback functions
         self._callbacks = {}
-        # for each capability, store the last value as an object
+        # for each capability, store callback functions for single fields
+        # as {field path: list of callbacks}, e.g. {'x': [func]} for 'accelerometer.x'
+        self._field_callbacks = {}
+        # for each capability, store the last value as an object.
+        # the dict is replaced instead of changed (copy on write),
+        # so readers always see the values of one complete update
         self._data = {}
+        # number of updates so far and the last published state, see snapshot()
+        self._sequence = 0
+        self._snapshot = SensorSnapshot(0, monotonic(), MappingProxyType(self._data))
+        self._update_condition = Condition()
+        # for each capability with enabled history, store a ring buffer of past values
+        self._history = {}
+        self._history_capacity = {}
+        # for each capability with filters, a _FilterChain, see add_filter()
+        self._filters = {}
+        # function that turns a received message into a dict, see set_decoder()
+        self._decoder = get_json_decoder()
+        # counters for the receiving path, see stats()
+        self._stats = _SensorStats()
+        self._stats_hook = None
+        # SensorRecorder that stores all received messages, see start_recording()
+        self._recorder = None
+        # number of received values that were replaced by newer ones before being applied
+        self._coalesced_count = 0
+        # calls callbacks on other threads, see set_dispatch()
+        self._dispatcher = None
+        # SensorReactor that receives data for this sensor instead of its own thread
+        self._reactor = None
         self._receiving = False
         Sensor.instances.append(self)
 
@@ -29,7 +67,13 @@ class Sensor():
     # so the program can terminate smoothly
     def disconnect(self):
         self._receiving = False
-        Sensor.instances.remove(self)
+        if self in Sensor.instances:
+            Sensor.instances.remove(self)
+        if self._dispatcher is not None:
+            self._dispatcher.stop()
+        self.stop_recording()
+        if self._reactor is not None:
+            self._reactor.unregister(self)
         if self._connection_thread:
             self._connection_thread.join()
 
@@ -37,34 +81,205 @@ class Sensor():
     # receives json formatted data from sensor,
     # stores it and notifies callbacks
     def _update(self, data):
+        data_json = self._decode(data)
+        if data_json is None:
+            return
+        self._apply(data_json)
+
+    # parses one json formatted message (str or bytes) or binary frame
+    # returns None if the data can not be used
+    def _decode(self, data):
+        # stop_recording() may be called on another thread at any time
+        recorder = self._recorder
+        if recorder is not None:
+            recorder.write(data)
+        self._stats.on_message(len(data))
+        if self._stats_hook is not None:
+            self._call_stats_hook_if_due()
         try:
-            data_json = json.loads(data)
-        except json.decoder.JSONDecodeError:
+            if isinstance(data, bytes) and data and data[0] == BINARY_MAGIC:
+                data_json = decode_binary_frame(data)
+            else:
+                data_json = self._decoder(data)
+        except ValueError:
             # incomplete data
+            self._stats.decode_errors += 1
+            return None
+        if not isinstance(data_json, dict):
+            self._stats.decode_errors += 1
+            return None
+        return data_json
+
+    # replace the function that decodes received messages.
+    # a decoder gets the message as str or bytes and returns a dict of
+    # {capability: value}. it raises ValueError if the message is invalid
+    def set_decoder(self, decoder):
+        self._decoder = decoder
+
+    # returns how many received messages could not be decoded
+    def get_decode_error_count(self):
+        return self._stats.decode_errors
+
+    # store every received message with a timestamp in a file, see SensorRecorder.
+    # recordings can be played back with SensorReplay
+    def start_recording(self, path):
+        self.stop_recording()
+        self._recorder = SensorRecorder(path)
+
+    def stop_recording(self):
+        recorder = self._recorder
+        self._recorder = None
+        if recorder is not None:
+            recorder.close()
+
+    # returns a dict of statistics about received data and callbacks:
+    #   messages, bytes: received in total
+    #   messages_per_second, bytes_per_second: received during the last full second
+    #   decode_errors: messages that could not be decoded
+    #   coalesced: values that were replaced by newer ones before being applied
+    #   dropped_callbacks: notifications dropped because callbacks could not keep up
+    #   interval_mean, jitter: mean time between messages and its mean deviation
+    #                          (as in RFC 3550), in seconds
+    #   callbacks: number of callback calls
+    #   callback_time_mean, callback_time_max: duration of callbacks in seconds
+    #   callback_time_histogram: {upper bound in microseconds: number of calls}
+    def stats(self):
+        stats = self._stats.get(monotonic())
+        stats['coalesced'] = self._coalesced_count
+        stats['dropped_callbacks'] = self.get_dropped_callback_count()
+        return stats
+
+    # call func(sensor.stats()) every <interval> seconds.
+    # it is called on the receiving thread with the next message after the interval.
+    # use None to remove it
+    def set_stats_hook(self, func, interval=1.0):
+        self._stats_hook = func
+        self._stats_hook_interval = interval
+        self._stats_hook_last_call = monotonic()
+
+    def _call_stats_hook_if_due(self):
+        now = monotonic()
+        if now - self._stats_hook_last_call >= self._stats_hook_interval:
+            self._stats_hook_last_call = now
+            self._stats_hook(self.stats())
+
+    # calls a callback and measures how long it takes
+    def _call(self, func, value):
+        start = perf_counter()
+        func(value)
+        self._stats.on_callback(perf_counter() - start)
+
+    # stores decoded values and notifies callbacks
+    def _apply(self, data_json):
+        self._apply_all([data_json])
+
+    # applies the values of several messages that arrived together.
+    # history and filters get every value, but only the newest value
+    # of each capability is stored and notified
+    def _apply_all(self, messages):
+        if not messages:
             return
+        for data_json in messages:
+            self._record_history(data_json)
+        if len(messages) == 1:
+            merged = messages[0]
+        else:
+            merged = {}
+            for data_json in messages:
+                merged.update(data_json)
+            self._coalesced_count += len(messages) - 1
+        if self._filters:
+            for key, filter_chain in self._filters.items():
+                if key in merged:
+                    values = [data_json[key] for data_json in messages if key in data_json]
+                    merged[key] = filter_chain.process(values)
+        self._store(merged)
 
-        for key, value in data_json.items():
+    def _store(self, data_json):
+        # the lock keeps capabilities added by other threads (e.g. by
+        # register_callback) from being lost when data is replaced
+        with self._update_condition:
+            changes = self._store_locked(data_json)
+        # callbacks are notified after all values of the update are stored
+        for key, changed_fields in changes:
+            self._notify_callbacks(key)
+            if changed_fields is not None:
+                self._notify_field_callbacks(key, changed_fields)
+
+    # returns (key, changed fields or None) of values that need notifications
+    def _store_locked(self, data_json):
+        for key in data_json:
             self._add_capability(key)
+        data = dict(self._data)
+        modified = False
+        changes = []
+        for key, value in data_json.items():
+            old_value = data[key]
 
             # do not notify callbacks on initialization
-            if self._data[key] == []:
-                self._data[key] = value
+            if old_value == []:
+                data[key] = value
+                modified = True
+                continue
+
+            # only compare single fields if somebody is interested in them,
+            # comparing whole dicts is faster otherwise
+            if key in self._field_callbacks and isinstance(value, dict):
+                changed_fields = _get_changed_fields(old_value, value)
+                if changed_fields:
+                    data[key] = value
+                    changes.append((key, changed_fields))
                 continue
 
             # notify callbacks only if data has changed
-            if self._data[key] != value:
-                self._data[key] = value
-                self._notify_callbacks(key)
+            if old_value != value:
+                data[key] = value
+                changes.append((key, None))
+
+        if modified or changes:
+            self._publish(data)
+        return changes
+
+    # makes a new state visible to get_value(), snapshot() and wait_for_update()
+    def _publish(self, data):
+        with self._update_condition:
+            self._sequence += 1
+            self._data = data
+            self._snapshot = SensorSnapshot(self._sequence, monotonic(), MappingProxyType(data))
+            self._update_condition.notify_all()
+
+    # returns the values of all capabilities as they were after one update,
+    # as a SensorSnapshot (sequence, timestamp, values).
+    # values is a read-only dict {capability: value} that does not change later.
+    # the sequence number increases with every update, see wait_for_update()
+    def snapshot(self):
+        return self._snapshot
+
+    # blocks until the sequence number is greater than since_sequence
+    # and returns the new snapshot, or None if timeout (in seconds) passes first
+    def wait_for_update(self, since_sequence, timeout=None):
+        snapshot = self._snapshot
+        if snapshot.sequence > since_sequence:
+            return snapshot
+        with self._update_condition:
+            if not self._update_condition.wait_for(lambda: self._sequence > since_sequence, timeout):
+                return None
+            return self._snapshot
 
     # checks if capability is available
     def has_capability(self, key):
         return key in self._capabilities
 
     def _add_capability(self, key):
-        if not self.has_capability(key):
-            self._capabilities.append(key)
-            self._callbacks[key] = []
-            self._data[key] = []
+        if self.has_capability(key):
+            return
+        with self._update_condition:
+            if not self.has_capability(key):
+                self._capabilities.append(key)
+                self._callbacks[key] = []
+                data = dict(self._data)
+                data[key] = []
+                self._data = data
 
     # returns a list of all current capabilities
     def get_capabilities(self):
@@ -79,13 +294,32 @@ class Sensor():
             #raise KeyError(f'"{key}" is not a capability of this sensor.')
             return None
 
-    # register a callback function for a change in specified capability
+    # register a callback function for a change in specified capability.
+    # fields of a capability can be specified with a dot, e.g. 'accelerometer.x'.
+    # such callbacks are only called if this field has changed and get its value
     def register_callback(self, key, func):
+        if '.' in key:
+            key, path = key.split('.', 1)
+            self._add_capability(key)
+            field_callbacks = self._field_callbacks.setdefault(key, {})
+            field_callbacks.setdefault(path, []).append(func)
+            return
         self._add_capability(key)
         self._callbacks[key].append(func)
 
     # remove already registered callback function for specified capability
     def unregister_callback(self, key, func):
+        if '.' in key:
+            key, path = key.split('.', 1)
+            field_callbacks = self._field_callbacks.get(key, {})
+            if func not in field_callbacks.get(path, []):
+                return False
+            field_callbacks[path].remove(func)
+            if not field_callbacks[path]:
+                del field_callbacks[path]
+            if not field_callbacks:
+                del self._field_callbacks[key]
+            return True
         if key in self._callbacks:
             self._callbacks[key].remove(func)
             return True
@@ -94,83 +328,1209 @@ class Sensor():
             return False
 
     def _notify_callbacks(self, key):
+        if self._dispatcher is not None:
+            if self._callbacks[key]:
+                self._dispatcher.submit(key, self._data[key])
+            return
         for func in self._callbacks[key]:
-            func(self._data[key])
+            self._call(func, self._data[key])
+
+    def _notify_field_callbacks(self, key, changed_fields):
+        for path, funcs in self._field_callbacks[key].items():
+            if path not in changed_fields:
+                continue
+            value = _get_field(self._data[key], path)
+            if self._dispatcher is not None:
+                self._dispatcher.submit(f'{key}.{path}', value)
+                continue
+            for func in funcs:
+                self._call(func, value)
+
+    # calls the callbacks for a capability or a field ('accelerometer.x')
+    # used by the dispatcher threads
+    def _run_callbacks(self, key, value):
+        if '.' in key:
+            key, path = key.split('.', 1)
+            funcs = self._field_callbacks.get(key, {}).get(path, [])
+        else:
+            funcs = self._callbacks.get(key, [])
+        # the list may be changed by register_callback() on another thread
+        for func in list(funcs):
+            self._call(func, value)
+
+    # configure on which thread callbacks are called:
+    #   'inline': on the thread that receives the data (default)
+    #   'thread': on a dedicated dispatcher thread
+    #   'pool': on a pool of <workers> threads, callbacks may run out of order
+    # with 'thread' and 'pool', slow callbacks do not hold up receiving.
+    # at most queue_size notifications wait for their callbacks, backpressure
+    # decides what happens if callbacks can not keep up:
+    #   'latest': a waiting notification for the same capability gets the newer value
+    #   'drop_oldest': the oldest waiting notification is dropped if the queue is full
+    # see get_dropped_callback_count()
+    def set_dispatch(self, policy='inline', queue_size=64, backpressure='latest', workers=4):
+        if policy not in ('inline', 'thread', 'pool'):
+            raise ValueError(f'unknown dispatch policy "{policy}".')
+        if backpressure not in ('latest', 'drop_oldest'):
+            raise ValueError(f'unknown backpressure "{backpressure}".')
+        if self._dispatcher is not None:
+            self._dispatcher.stop()
+            self._dispatcher = None
+        if policy == 'inline':
+            return
+        number_of_threads = 1 if policy == 'thread' else workers
+        self._dispatcher = _CallbackDispatcher(self._run_callbacks, number_of_threads, queue_size, backpressure == 'latest')
+
+    # returns how many notifications were dropped or replaced by newer ones
+    # because callbacks could not keep up (only with 'thread' and 'pool' dispatch)
+    def get_dropped_callback_count(self):
+        if self._dispatcher is None:
+            return 0
+        return self._dispatcher.dropped
+
+    # add a filter to the values of the specified capability, e.g.
+    #   sensor.add_filter('accelerometer', ExponentialSmoothing(0.3))
+    # filters run in the order they were added, on all values of a batch at once.
+    # get_value(), snapshot() and callbacks get the filtered values,
+    # the history keeps the unfiltered ones. requires numpy
+    def add_filter(self, key, signal_filter):
+        if key not in self._filters:
+            self._filters[key] = _FilterChain()
+        self._filters[key].filters.append(signal_filter)
+
+    # remove all filters of the specified capability
+    def clear_filters(self, key):
+        self._filters.pop(key, None)
+
+    # keep the last <capacity> values of the specified capability,
+    # timestamped with time.monotonic(). requires numpy
+    def enable_history(self, key, capacity=1024):
+        self._history_capacity[key] = capacity
+        # the buffer is allocated with the first value, as its shape depends on the data
+        self._history[key] = None
+
+    def disable_history(self, key):
+        self._history_capacity.pop(key, None)
+        self._history.pop(key, None)
+
+    def _record_history(self, data_json):
+        if not self._history:
+            return
+        timestamp = monotonic()
+        for key, value in data_json.items():
+            if key not in self._history:
+                continue
+            history = self._history[key]
+            if history is None:
+                history = _HistoryBuffer(self._history_capacity[key], value)
+                self._history[key] = history
+            history.append(timestamp, value)
+
+    # returns (timestamps, values) of the last n values (all if n is None)
+    # of the specified capability, oldest first.
+    # values has one column per field for capabilities like 'accelerometer'
+    # (see get_history_fields()) and is one-dimensional for single values.
+    # both arrays are views into the ring buffer and get overwritten by new data,
+    # so copy them if they are needed for longer.
+    # returns None if no history is available
+    def get_history(self, key, n=None):
+        history = self._history.get(key)
+        if history is None:
+            return None
+        return history.latest(n)
+
+    # same as get_history(), but returns all values received after timestamp t
+    def get_since(self, key, t):
+        history = self._history.get(key)
+        if history is None:
+            return None
+        return history.since(t)
+
+    # returns the field names of the columns returned by get_history()
+    # or None for capabilities with single values
+    def get_history_fields(self, key):
+        history = self._history.get(key)
+        if history is None:
+            return None
+        return history.fields
+
+# state of a Sensor after an update, see Sensor.snapshot()
+SensorSnapshot = namedtuple('SensorSnapshot', ['sequence', 'timestamp', 'values'])
+
+# compact binary alternative to json messages, all numbers are little-endian:
+#   header: BINARY_MAGIC (uint8), BINARY_VERSION (uint8), number of capabilities (uint8)
+#   for each capability: capability id (uint8), number of values (uint8),
+#   values (int32 for capabilities of type int, float32 otherwise)
+# the magic byte can not start a json message, so both formats can share a connection.
+# capabilities are identified by the ids in BINARY_CAPABILITIES, with either a tuple
+# of field names (decoded as dict of floats) or the type of their single value.
+# values of unknown capabilities are skipped, all values are 4 bytes long
+BINARY_MAGIC = 0xDB
+BINARY_VERSION = 2
+BINARY_CAPABILITIES = {
+    1: ('accelerometer', ('x', 'y', 'z')),
+    2: ('gyroscope', ('x', 'y', 'z')),
+    3: ('gravity', ('x', 'y', 'z')),
+    4: ('heartbeat', int),
+    16: ('button_1', int),
+    17: ('button_2', int),
+    18: ('button_3', int),
+    19: ('button_4', int),
+}
+_BINARY_CAPABILITY_IDS = {name: (capability_id, layout) for capability_id, (name, layout) in BINARY_CAPABILITIES.items()}
+_BINARY_HEADER = struct.Struct('<BBB')
+_BINARY_CAPABILITY_HEADER = struct.Struct('<BB')
+_BINARY_VALUE_SIZE = 4
+_MAX_BINARY_CAPABILITIES = 255
+_binary_values = {}
+# senders usually send frames with the same layout over and over, so each
+# layout is compiled into a single struct once, see _compile_binary_layout()
+_binary_layouts = {}
+_MAX_BINARY_LAYOUTS = 64
+
+# returns the struct format of the values of a capability with the given layout.
+# the layout of unknown capabilities is None, their values are read as floats
+def _get_binary_value_format(layout, count):
+    return f'{count}i' if layout is int else f'{count}f'
+
+# returns the number of values a capability with the given layout consists of
+def _get_binary_value_count(layout):
+    return len(layout) if isinstance(layout, tuple) else 1
+
+# returns a struct for the specified number of values of a capability
+def _get_binary_values_struct(layout, count):
+    value_format = _get_binary_value_format(layout, count)
+    values_struct = _binary_values.get(value_format)
+    if values_struct is None:
+        values_struct = struct.Struct('<' + value_format)
+        _binary_values[value_format] = values_struct
+    return values_struct
+
+# packs a dict of {capability: value} into a binary frame.
+# raises ValueError for capabilities that are not in BINARY_CAPABILITIES,
+# missing fields and values that do not fit into their type
+def encode_binary_frame(measures):
+    if len(measures) > _MAX_BINARY_CAPABILITIES:
+        raise ValueError(f'at most {_MAX_BINARY_CAPABILITIES} capabilities can be sent in a binary frame.')
+    parts = [_BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(measures))]
+    for key, value in measures.items():
+        if key not in _BINARY_CAPABILITY_IDS:
+            raise ValueError(f'"{key}" can not be sent in binary frames.')
+        capability_id, layout = _BINARY_CAPABILITY_IDS[key]
+        try:
+            if isinstance(layout, tuple):
+                values = [value[field] for field in layout]
+            else:
+                values = [value]
+            parts.append(_BINARY_CAPABILITY_HEADER.pack(capability_id, len(values)))
+            parts.append(_get_binary_values_struct(layout, len(values)).pack(*values))
+        except KeyError as e:
+            raise ValueError(f'"{key}" is missing the field {e}.')
+        except (TypeError, OverflowError, struct.error) as e:
+            raise ValueError(f'"{key}" can not be sent in binary frames: {e}')
+    return b''.join(parts)
+
+# unpacks a binary frame into a dict of {capability: value}.
+# capabilities with unknown ids are skipped.
+# raises ValueError if the frame is invalid
+def decode_binary_frame(data):
+    # fast path: a frame with the same length and headers has been decoded before
+    layout = _binary_layouts.get(len(data))
+    if layout is not None:
+        frame_struct, get_headers, headers, capabilities = layout
+        values = frame_struct.unpack(data)
+        if get_headers(values) == headers:
+            result = {}
+            for key, value_layout, index in capabilities:
+                if isinstance(value_layout, tuple):
+                    result[key] = dict(zip(value_layout, values[index:index + len(value_layout)]))
+                else:
+                    result[key] = values[index]
+            return result
+
+    result = _decode_binary_frame_slow(data)
+    _compile_binary_layout(data)
+    return result
+
+def _decode_binary_frame_slow(data):
+    try:
+        magic, version, count = _BINARY_HEADER.unpack_from(data, 0)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError(f'unsupported binary frame version {version}.')
+        offset = _BINARY_HEADER.size
+        result = {}
+        for i in range(count):
+            capability_id, number_of_values = _BINARY_CAPABILITY_HEADER.unpack_from(data, offset)
+            offset += _BINARY_CAPABILITY_HEADER.size
+            if capability_id not in BINARY_CAPABILITIES:
+                offset += _BINARY_VALUE_SIZE * number_of_values
+                continue
+            key, layout = BINARY_CAPABILITIES[capability_id]
+            if number_of_values != _get_binary_value_count(layout):
+                raise ValueError(f'"{key}" has {number_of_values} values in binary frame.')
+            values_struct = _get_binary_values_struct(layout, number_of_values)
+            values = values_struct.unpack_from(data, offset)
+            offset += values_struct.size
+            if isinstance(layout, tuple):
+                result[key] = dict(zip(layout, values))
+            else:
+                result[key] = values[0]
+        if offset > len(data):
+            raise ValueError('incomplete binary frame.')
+    except struct.error as e:
+        raise ValueError(f'incomplete binary frame: {e}')
+    return result
+
+# creates one struct for the whole frame and remembers
+# where the headers and the values of each capability are.
+# only called for frames that were decoded without errors
+def _compile_binary_layout(data):
+    if len(_binary_layouts) >= _MAX_BINARY_LAYOUTS:
+        _binary_layouts.clear()
+    frame_format = '<BBB'
+    header_indices = [0, 1, 2]
+    capabilities = []
+    index = 3
+    offset = _BINARY_HEADER.size
+    for i in range(data[2]):
+        capability_id, number_of_values = _BINARY_CAPABILITY_HEADER.unpack_from(data, offset)
+        offset += _BINARY_CAPABILITY_HEADER.size + _BINARY_VALUE_SIZE * number_of_values
+        key, value_layout = BINARY_CAPABILITIES.get(capability_id, (None, None))
+        frame_format += 'BB' + _get_binary_value_format(value_layout, number_of_values)
+        header_indices += [index, index + 1]
+        index += 2
+        if key is not None:
+            capabilities.append((key, value_layout, index))
+        index += number_of_values
+    # trailing bytes after the last capability are not part of the layout
+    if offset != len(data):
+        return
+    frame_struct = struct.Struct(frame_format)
+    get_headers = operator.itemgetter(*header_indices)
+    headers = get_headers(frame_struct.unpack(data))
+    _binary_layouts[len(data)] = (frame_struct, get_headers, headers, capabilities)
+
+_json_decoder = None
+
+# returns the fastest available function to parse json.
+# uses orjson or ujson if installed and the json module otherwise.
+# all of them accept str and bytes and raise a ValueError for invalid data
+def get_json_decoder():
+    global _json_decoder
+    if _json_decoder is not None:
+        return _json_decoder
+    try:
+        import orjson
+        _json_decoder = orjson.loads
+    except ImportError:
+        try:
+            import ujson
+            _json_decoder = ujson.loads
+        except ImportError:
+            _json_decoder = json.loads
+    return _json_decoder
+
+# returns the set of dotted paths of all fields that differ between two dicts.
+# for nested dicts, the path of the nested dict is included as well
+def _get_changed_fields(old, new, prefix=''):
+    changed = set()
+    if not isinstance(old, dict):
+        old = {}
+    for field, value in new.items():
+        old_value = old.get(field, _MISSING)
+        if old_value == value:
+            continue
+        path = prefix + field
+        changed.add(path)
+        if isinstance(value, dict):
+            changed.update(_get_changed_fields(old_value, value, path + '.'))
+    for field in old:
+        if field not in new:
+            changed.add(prefix + field)
+    return changed
+
+# returns the value at a dotted path in nested dicts, or None if it does not exist
+def _get_field(value, path):
+    for field in path.split('.'):
+        if not isinstance(value, dict) or field not in value:
+            return None
+        value = value[field]
+    return value
+
+_MISSING = object()
+
+# counters and timings of the receiving path of a Sensor
+class _SensorStats():
+    # number of buckets of the callback time histogram,
+    # bucket i counts durations of up to 2**i microseconds
+    HISTOGRAM_SIZE = 21
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.decode_errors = 0
+        self.callbacks = 0
+        self.callback_time = 0.0
+        self.callback_time_max = 0.0
+        self.callback_time_histogram = [0] * self.HISTOGRAM_SIZE
+        # rates are measured in windows of one second
+        self._window_start = monotonic()
+        self._window_messages = 0
+        self._window_bytes = 0
+        self._messages_per_second = 0.0
+        self._bytes_per_second = 0.0
+        self._last_arrival = None
+        self._last_interval = None
+        self._interval_sum = 0.0
+        self._intervals = 0
+        self._jitter = 0.0
+
+    def on_message(self, size):
+        now = monotonic()
+        self.messages += 1
+        self.bytes += size
+
+        if self._last_arrival is not None:
+            interval = now - self._last_arrival
+            self._interval_sum += interval
+            self._intervals += 1
+            if self._last_interval is not None:
+                # smoothed mean deviation of the interval, as in RFC 3550
+                self._jitter += (abs(interval - self._last_interval) - self._jitter) / 16
+            self._last_interval = interval
+        self._last_arrival = now
+
+        if now - self._window_start >= 1.0:
+            self._close_window(now)
+
+    def _close_window(self, now):
+        duration = now - self._window_start
+        self._messages_per_second = (self.messages - self._window_messages) / duration
+        self._bytes_per_second = (self.bytes - self._window_bytes) / duration
+        self._window_start = now
+        self._window_messages = self.messages
+        self._window_bytes = self.bytes
+
+    def on_callback(self, duration):
+        self.callbacks += 1
+        self.callback_time += duration
+        if duration > self.callback_time_max:
+            self.callback_time_max = duration
+        bucket = min(int(duration * 1000000).bit_length(), self.HISTOGRAM_SIZE - 1)
+        self.callback_time_histogram[bucket] += 1
+
+    def get(self, now):
+        # without messages, the rates would never drop to zero
+        if now - self._window_start >= 2.0:
+            self._close_window(now)
+        return {
+            'messages': self.messages,
+            'bytes': self.bytes,
+            'messages_per_second': self._messages_per_second,
+            'bytes_per_second': self._bytes_per_second,
+            'decode_errors': self.decode_errors,
+            'interval_mean': self._interval_sum / self._intervals if self._intervals else 0.0,
+            'jitter': self._jitter,
+            'callbacks': self.callbacks,
+            'callback_time_mean': self.callback_time / self.callbacks if self.callbacks else 0.0,
+            'callback_time_max': self.callback_time_max,
+            'callback_time_histogram': {2 ** i: count for i, count in enumerate(self.callback_time_histogram) if count},
+        }
+
+# runs callbacks on one or more threads, fed by a bounded queue of (key, value)
+class _CallbackDispatcher():
+    def __init__(self, run_callbacks, number_of_threads, queue_size, latest_value_wins):
+        self._run_callbacks = run_callbacks
+        self._queue_size = queue_size
+        self._latest_value_wins = latest_value_wins
+        # with latest_value_wins, only one notification per key is queued,
+        # so a dict {key: value} is used. it keeps the order of insertion
+        if latest_value_wins:
+            self._pending = {}
+        else:
+            self._pending = deque()
+        self._condition = Condition()
+        self._running = True
+        self.dropped = 0
+        self._threads = [Thread(target=self._work, daemon=True) for i in range(number_of_threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key, value):
+        with self._condition:
+            if self._latest_value_wins and key in self._pending:
+                self._pending[key] = value
+                self.dropped += 1
+                return
+            if len(self._pending) >= self._queue_size:
+                self._drop_oldest()
+                self.dropped += 1
+            if self._latest_value_wins:
+                self._pending[key] = value
+            else:
+                self._pending.append((key, value))
+            self._condition.notify()
+
+    def _drop_oldest(self):
+        if self._latest_value_wins:
+            del self._pending[next(iter(self._pending))]
+        else:
+            self._pending.popleft()
+
+    def _next(self):
+        if self._latest_value_wins:
+            key = next(iter(self._pending))
+            return key, self._pending.pop(key)
+        return self._pending.popleft()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while self._running and not self._pending:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                key, value = self._next()
+            try:
+                self._run_callbacks(key, value)
+            except Exception:
+                # a broken callback should not stop the dispatcher
+                traceback.print_exc()
+
+    # stops all threads, notifications that are still waiting are discarded
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        for thread in self._threads:
+            # stop() may be called from within a callback
+            if thread is not current_thread():
+                thread.join()
+
+# runs the filters of one capability.
+# values are converted to a numpy array with one row per value and
+# one column per field (or a single column for single values)
+class _FilterChain():
+    def __init__(self):
+        import numpy
+
+        self._numpy = numpy
+        self.filters = []
+        self.fields = None
+        self._layout_known = False
+        self._last_timestamp = None
+
+    # filters a list of values and returns the newest filtered value
+    def process(self, values):
+        numpy = self._numpy
+        if not self._layout_known:
+            if isinstance(values[0], dict):
+                self.fields = tuple(values[0].keys())
+            self._layout_known = True
+        try:
+            if self.fields is None:
+                rows = [[value] for value in values]
+            else:
+                rows = [[value[field] for field in self.fields] for value in values]
+            array = numpy.array(rows, dtype=float)
+        except (KeyError, TypeError, ValueError):
+            # value does not match the layout of the filters
+            return values[-1]
+
+        # values of a batch arrived together, so their timestamps are
+        # spread evenly since the last batch
+        now = monotonic()
+        if self._last_timestamp is None or len(values) == 1:
+            timestamps = numpy.full(len(values), now)
+        else:
+            timestamps = numpy.linspace(self._last_timestamp, now, len(values) + 1)[1:]
+        self._last_timestamp = now
+
+        for signal_filter in self.filters:
+            array = signal_filter.process(timestamps, array, self.fields)
+        newest = array[-1]
+        if self.fields is None:
+            return float(newest[0])
+        return dict(zip(self.fields, newest.tolist()))
+
+# filters for Sensor.add_filter().
+# process(timestamps, values, fields) gets an array with one row per value and
+# one column per field (fields is None for single values) and returns
+# the filtered array with the same shape. filters keep their state between calls
+
+# average of the last <window> values
+class MovingAverage():
+    def __init__(self, window):
+        import numpy
+
+        self._numpy = numpy
+        self.window = window
+        # the last window - 1 values of the previous call
+        self._previous = None
+
+    def process(self, timestamps, values, fields):
+        numpy = self._numpy
+        if self._previous is None:
+            self._previous = values[:0]
+        data = numpy.concatenate((self._previous, values))
+        sums = numpy.concatenate((numpy.zeros((1, data.shape[1])), numpy.cumsum(data, axis=0)))
+        ends = numpy.arange(len(self._previous) + 1, len(data) + 1)
+        starts = numpy.maximum(ends - self.window, 0)
+        result = (sums[ends] - sums[starts]) / (ends - starts)[:, None]
+        self._previous = data[max(len(data) - (self.window - 1), 0):] if self.window > 1 else data[:0]
+        return result
+
+# exponential smoothing: filtered = alpha * value + (1 - alpha) * previous filtered value.
+# the recursion is solved in closed form, so batches are filtered without a python loop
+class ExponentialSmoothing():
+    # values are processed in blocks, as the weights grow exponentially
+    BLOCK_SIZE = 32
+
+    def __init__(self, alpha):
+        import numpy
+
+        self._numpy = numpy
+        self.alpha = alpha
+        self._last = None
+
+    def process(self, timestamps, values, fields):
+        numpy = self._numpy
+        if self.alpha >= 1:
+            return values
+        if self._last is None:
+            self._last = values[0]
+        decay = 1 - self.alpha
+        result = numpy.empty_like(values)
+        for start in range(0, len(values), self.BLOCK_SIZE):
+            block = values[start:start + self.BLOCK_SIZE]
+            exponents = numpy.arange(1, len(block) + 1)[:, None]
+            # y_k = decay^k * (y_0 + alpha * sum of x_j * decay^-j for j <= k)
+            weighted_sums = numpy.cumsum(block * decay ** -exponents, axis=0)
+            filtered = decay ** exponents * (self._last + self.alpha * weighted_sums)
+            result[start:start + len(block)] = filtered
+            self._last = filtered[-1]
+        return result
+
+# One Euro filter (Casiez et al., 2012): smooths strongly while the value
+# changes slowly and follows quickly when it changes fast.
+# the cutoff depends on every previous value, so values are filtered one after another,
+# but all fields at once
+class OneEuroFilter():
+    def __init__(self, min_cutoff=1.0, beta=0.0, derivative_cutoff=1.0, rate=100):
+        import numpy
+
+        self._numpy = numpy
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.derivative_cutoff = derivative_cutoff
+        # used for the time between values if it can not be measured
+        self._default_interval = 1 / rate
+        self._last_value = None
+        self._last_derivative = None
+        self._last_timestamp = None
+
+    def _smoothing_factor(self, interval, cutoff):
+        tau = 1 / (2 * self._numpy.pi * cutoff)
+        return 1 / (1 + tau / interval)
+
+    def process(self, timestamps, values, fields):
+        numpy = self._numpy
+        result = numpy.empty_like(values)
+        for i in range(len(values)):
+            value = values[i]
+            if self._last_value is None:
+                self._last_value = value
+                self._last_derivative = numpy.zeros_like(value)
+                self._last_timestamp = timestamps[i]
+                result[i] = value
+                continue
+            interval = timestamps[i] - self._last_timestamp
+            if interval <= 0:
+                interval = self._default_interval
+            self._last_timestamp = timestamps[i]
+
+            derivative = (value - self._last_value) / interval
+            alpha = self._smoothing_factor(interval, self.derivative_cutoff)
+            derivative = alpha * derivative + (1 - alpha) * self._last_derivative
+            cutoff = self.min_cutoff + self.beta * numpy.abs(derivative)
+            alpha = self._smoothing_factor(interval, cutoff)
+            filtered = alpha * value + (1 - alpha) * self._last_value
+
+            self._last_value = filtered
+            self._last_derivative = derivative
+            result[i] = filtered
+        return result
+
+# sets values to 0 if their absolute value is below threshold
+class Deadzone():
+    def __init__(self, threshold):
+        import numpy
+
+        self._numpy = numpy
+        self.threshold = threshold
+
+    def process(self, timestamps, values, fields):
+        return self._numpy.where(self._numpy.abs(values) < self.threshold, 0.0, values)
+
+# subtracts a calibration offset, either a number or a dict with one number
+# per field, e.g. CalibrationOffset({'z': 9.81})
+class CalibrationOffset():
+    def __init__(self, offset):
+        import numpy
+
+        self._numpy = numpy
+        self.offset = offset
+
+    def process(self, timestamps, values, fields):
+        if isinstance(self.offset, dict):
+            if fields is None:
+                return values
+            offset = self._numpy.array([self.offset.get(field, 0.0) for field in fields])
+        else:
+            offset = self.offset
+        return values - offset
+
+# fixed-capacity ring buffer of timestamped values, backed by numpy arrays.
+# every value is written twice (at index and index + capacity),
+# so the newest n values are always a contiguous slice and can be returned as a view
+class _HistoryBuffer():
+    def __init__(self, capacity, first_value):
+        import numpy
+
+        self._numpy = numpy
+        self.capacity = capacity
+        # dict values (e.g. accelerometer) are stored with one column per field
+        if isinstance(first_value, dict):
+            self.fields = tuple(first_value.keys())
+        else:
+            self.fields = None
+        width = 1 if self.fields is None else len(self.fields)
+        self._timestamps = numpy.zeros(2 * capacity)
+        self._values = numpy.zeros((2 * capacity, width))
+        # position of the next write in [0, capacity)
+        self._index = 0
+        self._count = 0
+
+    def append(self, timestamp, value):
+        try:
+            if self.fields is None:
+                row = value
+            else:
+                row = [value[field] for field in self.fields]
+            i = self._index
+            self._values[i] = row
+            self._values[i + self.capacity] = row
+        except (KeyError, TypeError, ValueError):
+            # value does not match the layout of the buffer
+            return
+        self._timestamps[i] = timestamp
+        self._timestamps[i + self.capacity] = timestamp
+        self._index = (i + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def latest(self, n=None):
+        if n is None or n > self._count:
+            n = self._count
+        end = self._index + self.capacity
+        timestamps = self._timestamps[end - n:end]
+        values = self._values[end - n:end]
+        if self.fields is None:
+            values = values[:, 0]
+        return timestamps, values
+
+    def since(self, t):
+        timestamps, values = self.latest()
+        start = self._numpy.searchsorted(timestamps, t, side='right')
+        return timestamps[start:], values[start:]
 
 # sensor connected via WiFi/UDP
 # initialized with a UDP port
 # listens to all IPs by default
 # requires the socket module
+#
+# in batched mode, every datagram that is queued in the socket is read
+# in one go and only the newest value of each capability is applied.
+# max_datagram_size limits the size of a single datagram (larger ones are truncated)
+# and rcvbuf sets the size of the kernel receive buffer (SO_RCVBUF).
+# if a SensorReactor is given, it receives the data instead of a new thread
 class SensorUDP(Sensor):
-    def __init__(self, port, ip='0.0.0.0'):
+    def __init__(self, port, ip='0.0.0.0', batched=False, max_datagram_size=65535, rcvbuf=None, reactor=None):
         Sensor.__init__(self)
+        self._reactor = reactor
         self._ip = ip
         self._port = port
+        self._batched = batched
+        self._max_datagram_size = max_datagram_size
+        self._rcvbuf = rcvbuf
         self._connect()
 
     def _connect(self):
         import socket
 
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self._rcvbuf is not None:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._rcvbuf)
         self._sock.bind((self._ip, self._port))
+        # reads a single datagram without blocking and without changing the mode
+        # of the socket, which the receiving thread may be blocked in.
+        # not available on Windows
+        self._dontwait = getattr(socket, 'MSG_DONTWAIT', None)
+        if self._reactor is not None:
+            self._sock.setblocking(False)
+            self._connection_thread = None
+            self._receiving = True
+            self._reactor.register(self, self._sock, self._on_readable)
+            return
         self._connection_thread = Thread(target=self._receive)
         self._connection_thread.start()
 
     def _receive(self):
         self._receiving = True
         while self._receiving:
-            data, addr = self._sock.recvfrom(1024)
+            if self._batched:
+                self._apply_batch(self._receive_queued())
+                continue
+            data, addr = self._sock.recvfrom(self._max_datagram_size)
+            # decoders accept bytes, so there is no need to decode the data first
+            self._update(data)
+
+    # called by the reactor when datagrams are waiting
+    def _on_readable(self):
+        datagrams = self._receive_available()
+        if self._batched:
+            self._apply_batch(datagrams)
+            return
+        for data, addr in datagrams:
+            self._update(data)
+
+    # blocks until a datagram arrives, then reads all other queued datagrams
+    # without blocking. returns a list of (data, addr)
+    def _receive_queued(self):
+        datagrams = [self._sock.recvfrom(self._max_datagram_size)]
+        datagrams += self._receive_available()
+        return datagrams
+
+    # reads queued datagrams (at most limit) without blocking.
+    # returns a list of (data, addr)
+    def _receive_available(self, limit=256):
+        datagrams = []
+        if self._dontwait is not None:
             try:
-                data_decoded = data.decode()
-            except UnicodeDecodeError:
+                while len(datagrams) < limit:
+                    datagrams.append(self._sock.recvfrom(self._max_datagram_size, self._dontwait))
+            except BlockingIOError:
+                pass
+            return datagrams
+        timeout = self._sock.gettimeout()
+        self._sock.setblocking(False)
+        try:
+            while len(datagrams) < limit:
+                datagrams.append(self._sock.recvfrom(self._max_datagram_size))
+        except BlockingIOError:
+            pass
+        finally:
+            self._sock.settimeout(timeout)
+        return datagrams
+
+    # applies the merged values of all datagrams at once
+    def _apply_batch(self, datagrams):
+        messages = []
+        for data, addr in datagrams:
+            data_json = self._decode(data)
+            if data_json is not None:
+                messages.append(data_json)
+        self._apply_all(messages)
+
+    # returns how many datagrams were skipped in favor of newer ones in batched mode
+    def get_coalesced_count(self):
+        return self._coalesced_count
+
+    def disconnect(self):
+        Sensor.disconnect(self)
+        # the port can be used again afterwards
+        self._sock.close()
+
+# receives data from many devices on one UDP port and keeps a separate
+# Sensor for each device, with its own capabilities and callbacks.
+# devices are identified by their address (ip, port) or, if device_id_field is set,
+# by this field in their messages, e.g. {"device_id": "phone_1", "accelerometer": ...}.
+# the field is removed from the data, messages without it fall back to the address.
+# devices that did not send anything for idle_timeout seconds are removed.
+# the multiplexer itself does not store any values, use get_device() or
+# register_new_device_callback() to get the Sensor of a device.
+# other arguments are the same as for SensorUDP
+class SensorUDPMultiplexer(SensorUDP):
+    def __init__(self, port, ip='0.0.0.0', device_id_field=None, idle_timeout=10.0, **kwargs):
+        self._device_id_field = device_id_field
+        self._idle_timeout = idle_timeout
+        # {device id: Sensor}
+        self._devices = {}
+        self._last_seen = {}
+        self._new_device_callbacks = []
+        self._device_removed_callbacks = []
+        self._last_eviction = monotonic()
+        SensorUDP.__init__(self, port, ip, **kwargs)
+
+    def _connect(self):
+        SensorUDP._connect(self)
+        if self._reactor is not None:
+            self._reactor.register_tick(self, self._remove_idle_devices_if_due)
+            return
+        # wake up regularly to remove idle devices (and to notice a disconnect)
+        self._sock.settimeout(min(1.0, self._idle_timeout / 2))
+
+    def _on_readable(self):
+        datagrams = self._receive_available()
+        if datagrams:
+            self._route(datagrams)
+        self._remove_idle_devices_if_due()
+
+    def _receive(self):
+        import socket
+
+        self._receiving = True
+        while self._receiving:
+            try:
+                if self._batched:
+                    datagrams = self._receive_queued()
+                else:
+                    datagrams = [self._sock.recvfrom(self._max_datagram_size)]
+            except socket.timeout:
+                datagrams = []
+            except OSError:
+                # socket was closed
+                break
+            if datagrams:
+                self._route(datagrams)
+            self._remove_idle_devices_if_due()
+
+    # decodes datagrams and passes them to the Sensor of their device.
+    # in batched mode, the messages of each device are applied together
+    def _route(self, datagrams):
+        now = monotonic()
+        messages = {}
+        for data, addr in datagrams:
+            data_json = self._decode(data)
+            if data_json is None:
+                continue
+            device_id = addr
+            if self._device_id_field is not None:
+                device_id = data_json.pop(self._device_id_field, addr)
+                if not isinstance(device_id, (str, int, tuple)):
+                    # e.g. a dict, which can not be used as a key
+                    device_id = addr
+            device = self._devices.get(device_id)
+            if device is None:
+                device = self._add_device(device_id)
+            self._last_seen[device_id] = now
+            device._stats.on_message(len(data))
+            messages.setdefault(device_id, []).append(data_json)
+        for device_id, device_messages in messages.items():
+            self._devices[device_id]._apply_all(device_messages)
+
+    def _add_device(self, device_id):
+        device = SensorDevice(self, device_id)
+        self._devices[device_id] = device
+        for func in self._new_device_callbacks:
+            func(device_id, device)
+        return device
+
+    def _remove_device(self, device_id):
+        device = self._devices.pop(device_id, None)
+        self._last_seen.pop(device_id, None)
+        if device is None:
+            return
+        Sensor.disconnect(device)
+        for func in self._device_removed_callbacks:
+            func(device_id, device)
+
+    def _remove_idle_devices_if_due(self):
+        if monotonic() - self._last_eviction > self._idle_timeout / 4:
+            self._remove_idle_devices()
+
+    def _remove_idle_devices(self):
+        now = monotonic()
+        self._last_eviction = now
+        for device_id, last_seen in list(self._last_seen.items()):
+            if now - last_seen > self._idle_timeout:
+                self._remove_device(device_id)
+
+    # returns the Sensor of the specified device or None if it is unknown
+    def get_device(self, device_id):
+        return self._devices.get(device_id)
+
+    # returns a dict {device id: Sensor} of all current devices
+    def get_devices(self):
+        return dict(self._devices)
+
+    # register a callback function that is called with (device_id, sensor)
+    # when a device sends data for the first time
+    def register_new_device_callback(self, func):
+        self._new_device_callbacks.append(func)
+
+    # register a callback function that is called with (device_id, sensor)
+    # when a device is removed because it was idle
+    def register_device_removed_callback(self, func):
+        self._device_removed_callbacks.append(func)
+
+    def disconnect(self):
+        SensorUDP.disconnect(self)
+        for device_id in list(self._devices):
+            self._remove_device(device_id)
+
+# a device of a SensorUDPMultiplexer.
+# it has no connection of its own, the multiplexer passes received data to it
+class SensorDevice(Sensor):
+    def __init__(self, multiplexer, device_id):
+        Sensor.__init__(self)
+        self.device_id = device_id
+        self._multiplexer = multiplexer
+        self._connection_thread = None
+        self._receiving = True
+
+    # stop receiving data for this device
+    # it is added again as a new device if it sends data again
+    def disconnect(self):
+        if self._multiplexer.get_device(self.device_id) is self:
+            self._multiplexer._remove_device(self.device_id)
+        else:
+            Sensor.disconnect(self)
+
+# asyncio based sensor connected via WiFi/UDP
+# has the same API as SensorUDP, but does not start a thread.
+# instead, it receives datagrams on the running event loop,
+# so many sensors can share one loop with other async I/O.
+# callbacks are called on the event loop's thread.
+#
+#   async with AsyncSensorUDP(5700) as sensor:
+#       async for key, value in sensor:
+#           print(key, value)
+#
+# changed values are buffered for iteration once iteration has started,
+# at most queue_size of them (the oldest ones are dropped first)
+class AsyncSensorUDP(Sensor):
+    def __init__(self, port, ip='0.0.0.0', rcvbuf=None, queue_size=1024):
+        Sensor.__init__(self)
+        self._ip = ip
+        self._port = port
+        self._rcvbuf = rcvbuf
+        self._transport = None
+        self._connection_thread = None
+        self._updates = deque(maxlen=queue_size)
+        self._update_event = None
+        self._iterating = False
+
+    async def connect(self):
+        import socket
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self._rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._rcvbuf)
+        sock.bind((self._ip, self._port))
+
+        loop = asyncio.get_running_loop()
+        self._update_event = asyncio.Event()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: _SensorDatagramProtocol(self), sock=sock)
+        self._receiving = True
+        return self
+
+    def disconnect(self):
+        self._receiving = False
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        if self._update_event is not None:
+            # wake up pending iterators so they can finish
+            self._update_event.set()
+        Sensor.disconnect(self)
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.disconnect()
+
+    def __aiter__(self):
+        self._iterating = True
+        return self._iterate_updates()
+
+    # yields (capability, value) tuples for every change until disconnected
+    async def _iterate_updates(self):
+        while True:
+            if self._updates:
+                yield self._updates.popleft()
                 continue
-            self._update(data_decoded)
+            if not self._receiving:
+                return
+            self._update_event.clear()
+            await self._update_event.wait()
+
+    def _receive_datagram(self, data):
+        self._update(data)
+
+    def _notify_callbacks(self, key):
+        Sensor._notify_callbacks(self, key)
+        if self._iterating:
+            if len(self._updates) == self._updates.maxlen:
+                # the oldest update is dropped by the deque
+                self._coalesced_count += 1
+            self._updates.append((key, self._data[key]))
+            self._update_event.set()
+
+class _SensorDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, sensor):
+        self._sensor = sensor
+
+    def datagram_received(self, data, addr):
+        self._sensor._receive_datagram(data)
 
 # sensor connected via serial connection (USB)
 # initialized with a path to a TTY (e.g. /dev/ttyUSB0)
 # default baudrate is 115200
 # requires pyserial
+# reads everything that is available at once and splits it into lines.
+# if the connection is lost, it is opened again with increasing delays
+# (from RECONNECT_DELAY_MIN up to RECONNECT_DELAY_MAX seconds)
+# works with pseudo-terminals as well (see demo_serial_pty.py)
+# if a SensorReactor is given, it receives the data instead of a new thread
+# (this only works on POSIX systems, where serial ports can be selected)
 class SensorSerial(Sensor):
-    def __init__(self, tty, baudrate=115200):
+    RECONNECT_DELAY_MIN = 0.1
+    RECONNECT_DELAY_MAX = 5.0
+    # how long a read waits for data, so the thread notices disconnect()
+    READ_TIMEOUT = 0.5
+    # lines that are longer are dropped
+    MAX_LINE_LENGTH = 65536
+
+    def __init__(self, tty, baudrate=115200, reactor=None):
         Sensor.__init__(self)
         self._tty = tty
         self._baudrate = baudrate
+        self._reactor = reactor
+        # bytes received after the last complete line
+        self._buffer = bytearray()
+        self._reconnect_delay = self.RECONNECT_DELAY_MIN
+        self._next_reconnect = 0
+        # set by disconnect() to interrupt waiting for a reconnect
+        self._disconnected = Event()
         self._connect()
 
-    def _connect(self):
+    def _open(self):
         import serial
 
-        self._serial = serial.Serial(self._tty)
-        self._serial.baudrate = self._baudrate
+        timeout = 0 if self._reactor is not None else self.READ_TIMEOUT
+        self._serial = serial.Serial(self._tty, self._baudrate, timeout=timeout)
+        self._buffer.clear()
+        self._reconnect_delay = self.RECONNECT_DELAY_MIN
+
+    def _connect(self):
+        # errors on the first connection are passed to the caller
+        self._open()
+        self._receiving = True
+        if self._reactor is not None:
+            self._connection_thread = None
+            self._reactor.register(self, self._serial, self._on_readable)
+            return
         self._connection_thread = Thread(target=self._receive)
         self._connection_thread.start()
 
     def _receive(self):
-        self._receiving = True
+        import serial
+
+        while self._receiving:
+            try:
+                if self._serial is None:
+                    self._open()
+                # waits up to READ_TIMEOUT for the first byte
+                self._read_available()
+            except (serial.SerialException, OSError):
+                # connection lost, try again after a while
+                self._close()
+                if self._disconnected.wait(self._reconnect_delay):
+                    break
+                self._reconnect_delay = min(self._reconnect_delay * 2, self.RECONNECT_DELAY_MAX)
+
+    # called by the reactor when data is waiting
+    def _on_readable(self):
+        import serial
+
         try:
-            while self._receiving:
-                data = self._serial.readline()
-                try:
-                    data_decoded = data.decode()
-                except UnicodeDecodeError:
-                    continue
-                self._update(data)
-        except:
-            # connection lost, try again
-            self._connect()
+            self._read_available()
+        except (serial.SerialException, OSError):
+            # connection lost, try again on the reactor's ticks
+            self._reactor.unregister(self)
+            self._close()
+            self._next_reconnect = monotonic() + self._reconnect_delay
+            self._reactor.register_tick(self, self._reconnect_if_due)
+
+    def _reconnect_if_due(self):
+        import serial
+
+        if monotonic() < self._next_reconnect:
+            return
+        try:
+            self._open()
+        except (serial.SerialException, OSError):
+            self._reconnect_delay = min(self._reconnect_delay * 2, self.RECONNECT_DELAY_MAX)
+            self._next_reconnect = monotonic() + self._reconnect_delay
+            return
+        self._reactor.unregister(self)
+        self._serial.timeout = 0
+        self._reactor.register(self, self._serial, self._on_readable)
+
+    # reads everything available and applies all complete lines
+    def _read_available(self):
+        data = self._serial.read(self._serial.in_waiting or 1)
+        if not data:
+            return
+        self._buffer += data
+        end = self._buffer.rfind(b'\n')
+        if end < 0:
+            if len(self._buffer) > self.MAX_LINE_LENGTH:
+                # no line ending for too long, the data can not be used
+                self._buffer.clear()
+                self._stats.decode_errors += 1
+            return
+        lines = self._buffer[:end].split(b'\n')
+        del self._buffer[:end + 1]
+        for line in lines:
+            if line.strip():
+                self._update(bytes(line))
+
+    def _close(self):
+        if self._serial is not None:
+            try:
+                self._serial.close()
+            except (OSError, AttributeError):
+                pass
+            self._serial = None
+
+    def disconnect(self):
+        self._disconnected.set()
+        Sensor.disconnect(self)
+        self._close()
 
 # uses a Nintendo Wiimote as a sensor (connected via Bluetooth)
 # initialized with a Bluetooth address
 # requires wiimote.py (https://github.com/RaphaelWimmer/wiimote.py)
 # and pybluez
+# the wiimote is polled poll_rate times per second, all changed values
+# of a poll are applied together.
+# wiimote_module can replace wiimote.py, e.g. with a simulation (see demo_fake_wiimote.py)
 class SensorWiimote(Sensor):
-    def __init__(self, btaddr):
+    def __init__(self, btaddr, poll_rate=100, wiimote_module=None):
         Sensor.__init__(self)
         self._btaddr = btaddr
+        self._poll_rate = poll_rate
+        self._wiimote_module = wiimote_module
         self._connect()
 
     def _connect(self):
-        import wiimote
+        wiimote = self._wiimote_module
+        if wiimote is None:
+            import wiimote
 
         self._wiimote = wiimote.connect(self._btaddr)
         self._connection_thread = Thread(target=self._receive)
@@ -178,35 +1538,280 @@ class SensorWiimote(Sensor):
 
     def _receive(self):
         self._receiving = True
-        buttons = self._wiimote.buttons.BUTTONS.keys()
+        buttons = {button: 'button_' + button.lower() for button in self._wiimote.buttons.BUTTONS.keys()}
+        last_acceleration = None
+        last_states = {}
+        interval = 1 / self._poll_rate
+        next_poll = monotonic()
         while self._receiving:
-            x = self._wiimote.accelerometer[0]
-            y = self._wiimote.accelerometer[1]
-            z = self._wiimote.accelerometer[2]
-            data_string = f'{{"x":{x},"y":{y},"z":{z}}}'
-            self._update('accelerometer', data_string)
+            changes = {}
+            accelerometer = self._wiimote.accelerometer
+            acceleration = (accelerometer[0], accelerometer[1], accelerometer[2])
+            if acceleration != last_acceleration:
+                last_acceleration = acceleration
+                changes['accelerometer'] = {'x': acceleration[0], 'y': acceleration[1], 'z': acceleration[2]}
 
-            for button in buttons:
+            for button, key in buttons.items():
                 state = int(self._wiimote.buttons[button])
-                self._update(f'button_' + button.lower(), state)
-            sleep(0.001)
+                if last_states.get(button) != state:
+                    last_states[button] = state
+                    changes[key] = state
 
-    def _update(self, key, value):
-        self._add_capability(key)
-        
-        # do not notify callbacks on initialization
-        if self._data[key] == []:
-            self._data[key] = value
+            if changes:
+                self._apply(changes)
+
+            # wait for the next poll, without drifting if a poll took longer
+            next_poll += interval
+            delay = next_poll - monotonic()
+            if delay > 0:
+                sleep(delay)
+            else:
+                next_poll = monotonic()
+
+# stores raw messages with their time of arrival in an append-only file.
+# the file starts with RECORDING_MAGIC, followed by one record per message:
+#   time.time() of arrival (float64), length (uint32), message (bytes)
+# all numbers are little-endian. use iter_recording() to read it
+RECORDING_MAGIC = b'DIPPIDR1'
+_RECORD_HEADER = struct.Struct('<dI')
+
+# write() and close() can be called on different threads,
+# messages written after close() are dropped
+class SensorRecorder():
+    def __init__(self, path):
+        self._file = open(path, 'ab')
+        self._lock = Lock()
+        if self._file.tell() == 0:
+            self._file.write(RECORDING_MAGIC)
+
+    def write(self, data, timestamp=None):
+        if isinstance(data, str):
+            data = data.encode()
+        if timestamp is None:
+            timestamp = time()
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(_RECORD_HEADER.pack(timestamp, len(data)))
+            self._file.write(data)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+# yields (timestamp, message) for every message in a recording.
+# the file is memory-mapped, so even long recordings are not read at once
+def iter_recording(path):
+    import mmap
+
+    with open(path, 'rb') as file:
+        if file.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise ValueError(f'"{path}" is not a DIPPID recording.')
+        if file.seek(0, 2) == len(RECORDING_MAGIC):
+            # empty recordings can not be mapped
             return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as recording:
+            offset = len(RECORDING_MAGIC)
+            end = len(recording) - _RECORD_HEADER.size
+            while offset <= end:
+                timestamp, length = _RECORD_HEADER.unpack_from(recording, offset)
+                offset += _RECORD_HEADER.size
+                if offset + length > len(recording):
+                    # the last record was not written completely
+                    return
+                yield timestamp, recording[offset:offset + length]
+                offset += length
 
-        # notify callbacks only if data has changed
-        if self._data[key] != value:
-            self._data[key] = value
-            self._notify_callbacks(key)
+# plays back a recording of SensorRecorder as if the messages were received again.
+# speed 1.0 keeps the original timing, 2.0 plays back twice as fast
+# and None plays back as fast as possible.
+# with start=False, no thread is started and run() plays back on the calling thread,
+# e.g. for deterministic benchmarks
+class SensorReplay(Sensor):
+    def __init__(self, path, speed=1.0, loop=False, start=True):
+        Sensor.__init__(self)
+        self._path = path
+        self._speed = speed
+        self._loop = loop
+        self._connection_thread = None
+        if start:
+            self._connect()
+
+    def _connect(self):
+        self._receiving = True
+        self._connection_thread = Thread(target=self.run)
+        self._connection_thread.start()
+
+    # plays back the recording, returns when it is finished (or disconnected)
+    def run(self):
+        self._receiving = True
+        while self._receiving:
+            self._replay_once()
+            if not self._loop:
+                break
+        self._receiving = False
+
+    def _replay_once(self):
+        start = None
+        for timestamp, data in iter_recording(self._path):
+            if not self._receiving:
+                return
+            if self._speed:
+                if start is None:
+                    start = (monotonic(), timestamp)
+                due = start[0] + (timestamp - start[1]) / self._speed
+                delay = due - monotonic()
+                if delay > 0:
+                    sleep(delay)
+            self._update(data)
+
+    # returns True while the recording is played back
+    def is_playing(self):
+        return self._receiving
+
+    # waits until the recording is finished
+    def wait(self, timeout=None):
+        if self._connection_thread is not None:
+            self._connection_thread.join(timeout)
+
+# receives data for many sensors in a single thread, using the selectors module.
+# sensors are added by passing the reactor to their constructor:
+#   reactor = SensorReactor()
+#   sensor_1 = SensorUDP(5700, reactor=reactor)
+#   sensor_2 = SensorUDP(5701, reactor=reactor)
+# the thread is started with the first sensor and stops when the last one is disconnected.
+# a socket pair is used to wake the thread up, so disconnect() returns immediately
+# instead of waiting for the next packet
+class SensorReactor():
+    # how often tick functions are called at least, in seconds
+    TICK_INTERVAL = 0.5
+
+    def __init__(self):
+        import selectors
+        import socket
+
+        self._selectors = selectors
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._wakeup_sender.setblocking(False)
+        self._selector.register(self._wakeup_receiver, selectors.EVENT_READ, None)
+        # {sensor: file object}
+        self._sensors = {}
+        # {sensor: function} called regularly on the reactor's thread
+        self._ticks = {}
+        # changes of the registered sensors are done by the reactor's thread,
+        # as selectors are not thread-safe
+        self._pending = deque()
+        self._lock = Lock()
+        self._thread = None
+
+    # receive data from a file object (socket or serial port) for a sensor.
+    # on_readable is called on the reactor's thread whenever data is waiting
+    def register(self, sensor, fileobj, on_readable):
+        self._run_on_reactor(self._register, sensor, fileobj, on_readable)
+
+    # call a function for a sensor regularly, even if no data arrives
+    def register_tick(self, sensor, func):
+        self._run_on_reactor(self._ticks.__setitem__, sensor, func)
+
+    # stop receiving data for a sensor.
+    # returns when the reactor does not use the sensor's file object anymore
+    def unregister(self, sensor):
+        self._run_on_reactor(self._unregister, sensor)
+
+    def _register(self, sensor, fileobj, on_readable):
+        self._selector.register(fileobj, self._selectors.EVENT_READ, on_readable)
+        self._sensors[sensor] = fileobj
+
+    def _unregister(self, sensor):
+        self._ticks.pop(sensor, None)
+        fileobj = self._sensors.pop(sensor, None)
+        if fileobj is not None:
+            self._selector.unregister(fileobj)
+
+    def _run_on_reactor(self, func, *args):
+        if current_thread() is self._thread:
+            func(*args)
+            return
+        # [event that is set when done, raised exception]
+        result = [Event(), None]
+        with self._lock:
+            self._pending.append((func, args, result))
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.start()
+        self._wake_up()
+        result[0].wait()
+        if result[1] is not None:
+            raise result[1]
+
+    def _wake_up(self):
+        try:
+            self._wakeup_sender.send(b'\0')
+        except BlockingIOError:
+            # the thread is already about to wake up
+            pass
+
+    def _run_pending(self):
+        while self._pending:
+            func, args, result = self._pending.popleft()
+            try:
+                func(*args)
+            except Exception as e:
+                # raised again on the calling thread
+                result[1] = e
+            result[0].set()
+
+    def _run(self):
+        try:
+            self._loop()
+        finally:
+            with self._lock:
+                # only if the loop stopped because of an error, otherwise
+                # another thread may already have been started
+                if self._thread is current_thread():
+                    self._thread = None
+                    # the callers would wait forever otherwise
+                    while self._pending:
+                        func, args, result = self._pending.popleft()
+                        result[1] = RuntimeError('the reactor stopped because of an error.')
+                        result[0].set()
+
+    def _loop(self):
+        last_tick = monotonic()
+        while True:
+            with self._lock:
+                self._run_pending()
+                if not self._sensors and not self._ticks:
+                    self._thread = None
+                    return
+            timeout = self.TICK_INTERVAL if self._ticks else None
+            for key, events in self._selector.select(timeout):
+                if key.data is None:
+                    # woken up by the socket pair
+                    try:
+                        self._wakeup_receiver.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    key.data()
+                except Exception:
+                    # one broken sensor should not stop all others
+                    traceback.print_exc()
+            if self._ticks and monotonic() - last_tick >= self.TICK_INTERVAL:
+                last_tick = monotonic()
+                for func in list(self._ticks.values()):
+                    try:
+                        func()
+                    except Exception:
+                        traceback.print_exc()
 
 # close the program softly when ctrl+c is pressed
 def handle_interrupt_signal(signal, frame):
-    for sensor in Sensor.instances:
+    # disconnect() removes sensors from the list, so iterate over a copy
+    for sensor in list(Sensor.instances):
         sensor.disconnect()
     sys.exit(0)
 
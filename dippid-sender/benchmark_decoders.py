@@ -0,0 +1,63 @@
+import json
+import random
+import timeit
+
+from DIPPID import get_json_decoder
+
+# compares the decoders available to Sensor on DIPPID messages
+# as they are sent by DIPPID-sender.py and simple-sender.py
+
+NUMBER_OF_MESSAGES = 1000
+REPETITIONS = 5
+
+def generate_accelerometer_messages(count:int):
+    messages = []
+    for i in range(count):
+        measures = {
+            "accelerometer": {
+                "x": random.uniform(-1, 1),
+                "y": random.uniform(-1, 1),
+                "z": random.uniform(-1, 1),
+            },
+            "button_1": random.randint(0, 1),
+        }
+        messages.append(json.dumps(measures).encode())
+    return messages
+
+def generate_heartbeat_messages(count:int):
+    return [('{"heartbeat" : ' + str(i) + '}').encode() for i in range(count)]
+
+def get_decoders():
+    decoders = {"json": json.loads}
+    for module_name in ("ujson", "orjson"):
+        try:
+            module = __import__(module_name)
+        except ImportError:
+            continue
+        decoders[module_name] = module.loads
+    return decoders
+
+# returns the best time per message in microseconds
+def benchmark(decoder, messages:list[bytes]):
+    def decode_all():
+        for message in messages:
+            decoder(message)
+    best = min(timeit.repeat(decode_all, number=1, repeat=REPETITIONS))
+    return best / len(messages) * 1000000
+
+def main():
+    payloads = {
+        "accelerometer + button": generate_accelerometer_messages(NUMBER_OF_MESSAGES),
+        "heartbeat": generate_heartbeat_messages(NUMBER_OF_MESSAGES),
+    }
+    decoders = get_decoders()
+    print(f"default decoder of Sensor: {get_json_decoder().__module__}")
+    for payload_name, messages in payloads.items():
+        print(f"\n{payload_name} ({len(messages[0])} bytes per message)")
+        results = {name: benchmark(decoder, messages) for name, decoder in decoders.items()}
+        reference = results["json"]
+        for decoder_name, microseconds in results.items():
+            print(f"  {decoder_name:28} {microseconds:6.2f} us/msg  {1000000 / microseconds:10.0f} msg/s  x{reference / microseconds:.2f}")
+
+if __name__ == "__main__":
+    main()
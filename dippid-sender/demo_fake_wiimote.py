@@ -0,0 +1,58 @@
+import math
+import time
+import types
+
+from DIPPID import SensorWiimote
+
+# runs SensorWiimote without a Wiimote or Bluetooth.
+# a stand-in for wiimote.py generates synthetic readings:
+# the accelerometer swings slowly and button A is pressed every second.
+
+POLL_RATE = 200
+DURATION = 3
+
+class FakeButtons():
+    BUTTONS = {"A": 0x0008, "B": 0x0004, "Up": 0x0800, "Down": 0x0400}
+
+    def __init__(self, start_time:float):
+        self._start_time = start_time
+
+    def __getitem__(self, button:str) -> bool:
+        if button == "A":
+            # pressed for 0.2 seconds every second
+            return (time.time() - self._start_time) % 1.0 < 0.2
+        return False
+
+class FakeAccelerometer():
+    def __init__(self, start_time:float):
+        self._start_time = start_time
+
+    def __getitem__(self, axis:int) -> int:
+        # the real wiimote reports integers, so small movements do not change the value
+        elapsed = time.time() - self._start_time
+        return 512 + int(100 * math.sin(elapsed + axis))
+
+class FakeWiimote():
+    def __init__(self):
+        start_time = time.time()
+        self.accelerometer = FakeAccelerometer(start_time)
+        self.buttons = FakeButtons(start_time)
+
+fake_wiimote_module = types.SimpleNamespace(connect=lambda btaddr: FakeWiimote())
+
+updates = {"accelerometer": 0}
+
+def count_accelerometer(data):
+    updates["accelerometer"] += 1
+
+def print_button(data):
+    print("button A:", data)
+
+sensor = SensorWiimote("00:00:00:00:00:00", poll_rate=POLL_RATE, wiimote_module=fake_wiimote_module)
+sensor.register_callback("accelerometer", count_accelerometer)
+sensor.register_callback("button_a", print_button)
+time.sleep(DURATION)
+sensor.disconnect()
+
+print(f"{POLL_RATE * DURATION} polls, {updates['accelerometer']} accelerometer changes")
+print("last accelerometer value:", sensor.get_value("accelerometer"))
@@ -0,0 +1,66 @@
+import os
+import pty
+import tty
+import json
+import time
+import tempfile
+
+from DIPPID import SensorSerial
+
+# simulates a serial device with a pseudo-terminal pair, so SensorSerial
+# can be tried without hardware (POSIX only).
+# SensorSerial opens a symlink to the pseudo-terminal. halfway through,
+# the device is "unplugged" and replaced by a new pseudo-terminal
+# to show that the sensor reconnects.
+
+MESSAGES_PER_DEVICE = 200
+RATE = 100
+
+def plug_in_device(link_path:str):
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+    os.symlink(os.ttyname(slave), link_path)
+    return master, slave
+
+def unplug_device(master:int, slave:int):
+    os.close(master)
+    os.close(slave)
+
+def send_messages(master:int, start:int, count:int):
+    for counter in range(start, start + count):
+        message = json.dumps({"heartbeat": counter}) + "\n"
+        # write the message in two parts, as serial devices often do
+        middle = len(message) // 2
+        os.write(master, message[:middle].encode())
+        os.write(master, message[middle:].encode())
+        time.sleep(1 / RATE)
+
+def handle_heartbeat(data):
+    if data % 50 == 0:
+        print(data)
+
+link_path = os.path.join(tempfile.mkdtemp(), "ttyDIPPID")
+
+master, slave = plug_in_device(link_path)
+sensor = SensorSerial(link_path)
+sensor.register_callback("heartbeat", handle_heartbeat)
+send_messages(master, 0, MESSAGES_PER_DEVICE)
+time.sleep(0.1)
+
+print("unplugging device")
+unplug_device(master, slave)
+time.sleep(0.5)
+master, slave = plug_in_device(link_path)
+print("device plugged in again")
+# give the sensor time to reconnect
+time.sleep(SensorSerial.RECONNECT_DELAY_MAX)
+send_messages(master, MESSAGES_PER_DEVICE, MESSAGES_PER_DEVICE)
+time.sleep(0.1)
+
+print("last value:", sensor.get_value("heartbeat"))
+print(sensor.stats())
+sensor.disconnect()
+unplug_device(master, slave)
+os.remove(link_path)
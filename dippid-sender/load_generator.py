@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import socket
+import argparse
+import importlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# the sender's file name is not a valid module name, so it is imported by name
+sender = importlib.import_module("DIPPID-sender")
+from DIPPID import encode_binary_frame
+
+# simulates many DIPPID devices to load-test a receiver such as SensorUDP or
+# SensorUDPMultiplexer. every virtual device sends from its own socket (and
+# therefore its own source port) and adds its id to each json message.
+# the devices are spread over a pool of processes, each of which sends at
+# the device rate with the scheduler of DIPPID-sender.py.
+#
+# example: 200 devices at 100 Hz on 4 processes, ramped up over 10 seconds
+#   python load_generator.py -n 200 -r 100 -p 4 --ramp linear --ramp-time 10
+
+# add heartbeat (e.g. -c accelerometer,button_1,heartbeat) to number the messages
+# of each device, so the receiver can detect lost messages
+DEFAULT_CAPABILITIES = "accelerometer,button_1"
+RAMP_PROFILES = ("constant", "linear", "step")
+# far apart offsets into the generated signal, so devices do not send the same values
+DEVICE_TIME_OFFSET:float = 1000.0
+# the full 8000 layers of DIPPID-sender.py are too slow for hundreds of devices
+DEFAULT_SIN_LAYERS = 64
+# gives the processes time to start up before the first message is sent
+START_DELAY:float = 1.0
+
+def parse_capability_mix(groups:list[str]) -> list[list[str]]:
+    mix = []
+    for group in groups:
+        capabilities = [capability.strip() for capability in group.split(",") if capability.strip()]
+        for capability in capabilities:
+            if capability not in sender.CAPABILITY_GENERATORS:
+                raise argparse.ArgumentTypeError(f"unsupported capability: {capability} (supported: {', '.join(sender.CAPABILITY_GENERATORS)})")
+        if not capabilities:
+            raise argparse.ArgumentTypeError("empty capability group")
+        mix.append(capabilities)
+    return mix
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Simulates many DIPPID devices sending over UDP.")
+    parser.add_argument("-n", "--devices", type=int, default=10, help="number of virtual devices")
+    parser.add_argument("-r", "--rate", type=float, default=100, help="messages per second of each device")
+    parser.add_argument("-d", "--duration", type=float, default=10, help="seconds to send")
+    parser.add_argument("-p", "--processes", type=int, default=None, help="size of the process pool (default: number of cpus)")
+    parser.add_argument("--ip", default=sender.IP, help="address of the receiver")
+    parser.add_argument("--port", type=int, default=sender.PORT, help="port of the receiver")
+    parser.add_argument("--source-port", type=int, default=0,
+                        help="source port of the first device, the others use the following ports (default: any free port)")
+    parser.add_argument("--device-id-field", default="device_id",
+                        help="json field that carries the device id (use the same for SensorUDPMultiplexer)")
+    parser.add_argument("-c", "--capabilities", action="append", default=None,
+                        help="comma separated capabilities of a device; repeat to assign different mixes round-robin "
+                             f"(default: {DEFAULT_CAPABILITIES})")
+    parser.add_argument("--ramp", choices=RAMP_PROFILES, default="constant",
+                        help="how devices are switched on: all at once, one after another or in steps")
+    parser.add_argument("--ramp-time", type=float, default=0.0, help="seconds until all devices are sending")
+    parser.add_argument("--ramp-steps", type=int, default=4, help="number of steps of the step profile")
+    parser.add_argument("--layers", type=int, default=DEFAULT_SIN_LAYERS, help="sine layers of the generated signal")
+    parser.add_argument("--binary", action="store_true",
+                        help="send binary frames (these carry no device id, so devices are told apart by source port)")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the generated signal")
+    arguments = parser.parse_args(args)
+    if arguments.devices < 1:
+        parser.error("at least one device is needed")
+    if arguments.rate <= 0:
+        parser.error("rate must be positive")
+    try:
+        arguments.capabilities = parse_capability_mix(arguments.capabilities or [DEFAULT_CAPABILITIES])
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    return arguments
+
+# seconds after the start at which the device starts sending
+def get_device_start(device_index:int, device_count:int, ramp:str, ramp_time:float, ramp_steps:int) -> float:
+    if ramp == "constant" or ramp_time <= 0:
+        return 0.0
+    if ramp == "linear":
+        return ramp_time * device_index / device_count
+    # step: the devices are split into ramp_steps groups that start ramp_time / ramp_steps apart
+    step = device_index * ramp_steps // device_count
+    return ramp_time * step / ramp_steps
+
+class VirtualDevice():
+    def __init__(self, index:int, capabilities:list[str], start:float, source_port:int, device_id_field:str):
+        self.index = index
+        self.device_id = f"device-{index}"
+        self.capabilities = capabilities
+        self.start = start
+        self.time_offset = index * DEVICE_TIME_OFFSET
+        self.device_id_field = device_id_field
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("", source_port))
+        self.source_port = self.sock.getsockname()[1]
+        self.sent = 0
+        self.sent_bytes = 0
+        self.errors = 0
+
+    def create_message(self, time_since_start:float, binary:bool) -> bytes:
+        measures = sender.generate_values(time_since_start + self.time_offset, self.capabilities, self.sent)
+        if binary:
+            return encode_binary_frame(measures)
+        measures[self.device_id_field] = self.device_id
+        return json.dumps(measures).encode()
+
+    def send(self, message:bytes, address:tuple):
+        try:
+            self.sock.sendto(message, address)
+        except OSError:
+            # e.g. full socket buffers: the message is lost, as it would be on a network
+            self.errors += 1
+            return
+        self.sent += 1
+        self.sent_bytes += len(message)
+
+    def get_stats(self, end:float) -> dict:
+        return {
+            "device_id": self.device_id,
+            "source_port": self.source_port,
+            "sent": self.sent,
+            "bytes": self.sent_bytes,
+            "errors": self.errors,
+            "active_time": max(0.0, end - self.start),
+        }
+
+# runs in a worker process: sends for the given devices until the duration is over
+def run_devices(arguments, device_indices:list[int], start_at:float) -> dict:
+    # with a seed, all processes generate the same signal on every run
+    sender.initialize_random_values(arguments.seed, arguments.layers)
+    address = (arguments.ip, arguments.port)
+    devices = []
+    for index in device_indices:
+        capabilities = arguments.capabilities[index % len(arguments.capabilities)]
+        start = get_device_start(index, arguments.devices, arguments.ramp, arguments.ramp_time, arguments.ramp_steps)
+        source_port = arguments.source_port + index if arguments.source_port else 0
+        devices.append(VirtualDevice(index, capabilities, start, source_port, arguments.device_id_field))
+
+    # all processes start at the same wall clock time, so the ramp is the same for all of them
+    time.sleep(max(0.0, start_at - time.time()))
+    scheduler = sender.RateScheduler(arguments.rate, "skip")
+    time_since_start = 0.0
+    while True:
+        time_since_start = scheduler.wait()
+        if time_since_start >= arguments.duration:
+            break
+        for device in devices:
+            if time_since_start >= device.start:
+                device.send(device.create_message(time_since_start, arguments.binary), address)
+    for device in devices:
+        device.sock.close()
+    return {
+        "scheduler": scheduler.report(),
+        "devices": [device.get_stats(arguments.duration) for device in devices],
+    }
+
+def print_summary(arguments, results:list[dict]):
+    elapsed = arguments.duration
+    device_stats = [stats for result in results for stats in result["devices"]]
+    sent = sum(stats["sent"] for stats in device_stats)
+    sent_bytes = sum(stats["bytes"] for stats in device_stats)
+    errors = sum(stats["errors"] for stats in device_stats)
+    expected = sum(stats["active_time"] for stats in device_stats) * arguments.rate
+    device_rates = np.array([stats["sent"] / stats["active_time"] for stats in device_stats if stats["active_time"] > 0])
+
+    print(f"\n{arguments.devices} devices at {arguments.rate:g} Hz on {len(results)} processes for {elapsed:.1f} s ({arguments.ramp} ramp)")
+    print(f"  configured: {arguments.devices * arguments.rate:10.0f} msg/s at full load, {expected:.0f} messages in total")
+    print(f"  achieved:   {sent / elapsed:10.0f} msg/s, {sent} messages ({sent / expected * 100 if expected else 0:.1f} %), "
+          f"{sent_bytes / elapsed / 1000:.1f} kB/s")
+    if len(device_rates):
+        print(f"  per device: {device_rates.mean():.1f} Hz mean, {device_rates.min():.1f} Hz min, {device_rates.max():.1f} Hz max")
+    print(f"  send errors: {errors}")
+    for process_index, result in enumerate(results):
+        print(f"  process {process_index}: {sender.format_report(result['scheduler'])}")
+
+def split_devices(device_count:int, process_count:int) -> list[list[int]]:
+    return [list(range(process_index, device_count, process_count)) for process_index in range(process_count)]
+
+def main(args=None):
+    arguments = parse_arguments(args)
+    process_count = min(arguments.processes or os.cpu_count() or 1, arguments.devices)
+    groups = split_devices(arguments.devices, process_count)
+    start_at = time.time() + START_DELAY
+    print(f"sending to {arguments.ip}:{arguments.port} ...")
+    with ProcessPoolExecutor(max_workers=process_count) as pool:
+        futures = [pool.submit(run_devices, arguments, group, start_at) for group in groups]
+        results = [future.result() for future in futures]
+    print_summary(arguments, results)
+
+if __name__ == "__main__":
+    main()